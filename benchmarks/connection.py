@@ -0,0 +1,71 @@
+"""
+Compare the default SQLite setup with the tuned connection settings in functions/Database.py.
+
+Run from the repository root:
+    python -m benchmarks.connection
+"""
+import os, sys, tempfile, threading, time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks.harness import percentile
+from functions.Database import Database, PRAGMAS
+
+DEFAULT_PRAGMAS = {"journal_mode": "DELETE", "synchronous": "FULL"}
+USERS = 1000
+WRITES = 2000
+
+def run(name, pragmas, directory):
+    path = os.path.join(directory, f"{name}.db")
+    db = Database(path, pragmas=pragmas)
+    db.add_points_bulk([(userid, f"user{userid}", 0) for userid in range(USERS)])
+
+    # One commit per write, the way the bot used to award message points
+    start = time.perf_counter()
+    for index in range(WRITES):
+        db.add_points(index % USERS, 1)
+    per_call = WRITES / (time.perf_counter() - start)
+
+    # The same writes grouped into one transaction scope
+    start = time.perf_counter()
+    with db.transaction():
+        for index in range(WRITES):
+            db.add_points(index % USERS, 1)
+    batched = WRITES / (time.perf_counter() - start)
+
+    # Point lookups on a separate connection while the writer keeps committing
+    reader = Database(path, read_only=True, pragmas=pragmas)
+    latencies = []
+    stop = threading.Event()
+
+    def read():
+        while not stop.is_set():
+            started = time.perf_counter()
+            reader.get_user_points(len(latencies) % USERS)
+            latencies.append(time.perf_counter() - started)
+
+    thread = threading.Thread(target=read)
+    thread.start()
+    for index in range(WRITES):
+        db.add_points(index % USERS, 1)
+    stop.set()
+    thread.join()
+
+    reader.close_connection()
+    db.close_connection()
+    return {
+        "commits_per_sec": per_call,
+        "batched_writes_per_sec": batched,
+        "reads_during_writes": len(latencies),
+        "read_p50_ms": percentile(latencies, 0.5) * 1000,
+        "read_p99_ms": percentile(latencies, 0.99) * 1000,
+    }
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        results = {"default": run("default", DEFAULT_PRAGMAS, directory), "tuned": run("tuned", PRAGMAS, directory)}
+
+    print(f"{'metric':<24}{'default':>14}{'tuned':>14}")
+    for metric in results["default"]:
+        print(f"{metric:<24}{results['default'][metric]:>14.2f}{results['tuned'][metric]:>14.2f}")
+
+if __name__ == "__main__":
+    main()
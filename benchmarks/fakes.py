@@ -0,0 +1,119 @@
+"""
+Minimal stand-ins for the discord objects the Polls cog touches, so handlers can be driven without a gateway connection.
+Only the attributes the cog actually reads are provided.
+"""
+import itertools
+
+_ids = itertools.count(10 ** 17)
+
+def snowflake() -> int:
+    return next(_ids)
+
+class FakeUser:
+    def __init__(self, userid: int = None, name: str = None, bot: bool = False):
+        self.id = userid if userid is not None else snowflake()
+        self.name = name or f"user{self.id}"
+        self.bot = bot
+        self.mention = f"<@{self.id}>"
+
+class FakeGuild:
+    def __init__(self, guildid: int = None):
+        self.id = guildid if guildid is not None else snowflake()
+
+class FakeMessage:
+    def __init__(self, author: FakeUser, content: str = "", components=None, messageid: int = None, channel=None, guild: FakeGuild = None):
+        self.id = messageid if messageid is not None else snowflake()
+        self.author = author
+        self.guild = guild
+        self.content = content
+        self.components = components or []
+        self.channel = channel
+        self.edits = []
+
+    async def edit(self, **kwargs):
+        self.edits.append(kwargs)
+        return self
+
+class FakeChannel:
+    def __init__(self, channelid: int = None, guild: FakeGuild = None):
+        self.id = channelid if channelid is not None else snowflake()
+        self.guild = guild
+        self.mention = f"<#{self.id}>"
+        self.messages = {}
+
+    async def send(self, content=None, **kwargs):
+        message = FakeMessage(FakeUser(name="bot", bot=True), content=content or "", channel=self)
+        view = kwargs.get("view")
+        if view is not None:
+            message.components = [FakeActionRow(view.children)]
+        message.sent = kwargs
+        self.messages[message.id] = message
+        return message
+
+    def get_partial_message(self, messageid: int):
+        return self.messages.setdefault(messageid, FakeMessage(FakeUser(name="bot", bot=True), messageid=messageid, channel=self))
+
+class FakeActionRow:
+    def __init__(self, children):
+        self.children = list(children)
+
+class FakeResponse:
+    def __init__(self):
+        self.sent = []
+        self.modal = None
+        self.deferred = False
+
+    async def send_message(self, content=None, **kwargs):
+        self.sent.append((content, kwargs))
+
+    async def send_modal(self, modal):
+        self.modal = modal
+
+    async def defer(self, **kwargs):
+        self.deferred = True
+
+class FakeFollowup:
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, content=None, **kwargs):
+        self.sent.append((content, kwargs))
+
+class FakePermissions:
+    def __init__(self, administrator: bool):
+        self.administrator = administrator
+
+class FakeMember(FakeUser):
+    def __init__(self, userid: int = None, name: str = None, administrator: bool = False):
+        super().__init__(userid, name)
+        self.guild_permissions = FakePermissions(administrator)
+
+class FakeInteraction:
+    def __init__(self, user: FakeUser = None, message: FakeMessage = None, custom_id: str = None, guild_id: int = None):
+        self.user = user or FakeMember()
+        self.message = message
+        self.data = {"custom_id": custom_id} if custom_id is not None else {}
+        self.guild_id = guild_id
+        self.response = FakeResponse()
+        self.followup = FakeFollowup()
+
+class FakeBot:
+    def __init__(self):
+        self.channels = {}
+        self.views = []
+
+    def add_channel(self, channel: FakeChannel):
+        self.channels[channel.id] = channel
+        return channel
+
+    def get_channel(self, channelid: int):
+        return self.channels.get(channelid)
+
+    def add_view(self, view):
+        self.views.append(view)
+
+    async def wait_until_ready(self):
+        return
+
+    async def process_commands(self, message):
+        return
@@ -0,0 +1,91 @@
+"""
+Timing helpers shared by the benchmarks.
+"""
+import contextlib, json, os, shutil, tempfile, time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+def summarize(name: str, latencies, elapsed: float, **params) -> dict:
+    """
+    Turn a list of per-operation latencies into a result row.
+    :param name: Name of the benchmark.
+    :param latencies: Seconds taken by each operation.
+    :param elapsed: Wall-clock seconds for the whole run.
+    :param params: Parameters of the run, such as table sizes.
+    :return: A dict with ops, ops_per_sec, p50_ms and p99_ms.
+    """
+    return {
+        "name": name,
+        "params": params,
+        "ops": len(latencies),
+        "ops_per_sec": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 0.5) * 1000 if latencies else 0.0,
+        "p99_ms": percentile(latencies, 0.99) * 1000 if latencies else 0.0,
+    }
+
+def measure(name: str, operation, count: int, **params) -> dict:
+    """
+    Time a synchronous operation count times.
+    :param operation: A callable taking the iteration index.
+    """
+    latencies = []
+    start = time.perf_counter()
+    for index in range(count):
+        started = time.perf_counter()
+        operation(index)
+        latencies.append(time.perf_counter() - started)
+    return summarize(name, latencies, time.perf_counter() - start, **params)
+
+async def measure_async(name: str, operation, count: int, **params) -> dict:
+    """
+    Time a coroutine function count times, one after another.
+    :param operation: A coroutine function taking the iteration index.
+    """
+    latencies = []
+    start = time.perf_counter()
+    for index in range(count):
+        started = time.perf_counter()
+        await operation(index)
+        latencies.append(time.perf_counter() - started)
+    return summarize(name, latencies, time.perf_counter() - start, **params)
+
+@contextlib.contextmanager
+def workspace():
+    """
+    Run inside a temporary directory laid out like the bot's working directory, with an empty database and the shop file.
+    """
+    previous = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.makedirs(os.path.join(directory, "database"))
+        shutil.copy(os.path.join(ROOT, "database", "shop.txt"), os.path.join(directory, "database", "shop.txt"))
+        os.chdir(directory)
+        try:
+            yield directory
+        finally:
+            os.chdir(previous)
+
+def compare(results, baseline_path: str, tolerance: float):
+    """
+    Compare results with a previous run.
+    :param tolerance: Allowed relative drop in ops_per_sec before a benchmark counts as a regression.
+    :return: A list of (name, params, baseline ops/sec, current ops/sec) for every regression.
+    """
+    with open(baseline_path) as file:
+        baseline = {(row["name"], json.dumps(row["params"], sort_keys=True)): row for row in json.load(file)["results"]}
+
+    regressions = []
+    for row in results:
+        previous = baseline.get((row["name"], json.dumps(row["params"], sort_keys=True)))
+        if previous and row["ops_per_sec"] < previous["ops_per_sec"] * (1 - tolerance):
+            regressions.append((row["name"], row["params"], previous["ops_per_sec"], row["ops_per_sec"]))
+    return regressions
+
+def print_table(results):
+    print(f"{'benchmark':<32}{'params':<28}{'ops':>8}{'ops/sec':>14}{'p50 ms':>10}{'p99 ms':>10}")
+    for row in results:
+        params = ",".join(f"{key}={value}" for key, value in row["params"].items())
+        print(f"{row['name']:<32}{params:<28}{row['ops']:>8}{row['ops_per_sec']:>14.1f}{row['p50_ms']:>10.3f}{row['p99_ms']:>10.3f}")
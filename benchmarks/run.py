@@ -0,0 +1,308 @@
+"""
+Offline benchmarks for the Database and Polls hot paths.
+Everything runs against a temporary SQLite file with fake discord objects, no network is needed.
+
+Run from the repository root:
+    python -m benchmarks.run [--quick] [--output results.json] [--compare baseline.json]
+"""
+import argparse, asyncio, contextlib, io, json, os, platform, sqlite3, sys, time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks.fakes import FakeBot, FakeChannel, FakeInteraction, FakeMember, FakeMessage, FakeUser
+from benchmarks.harness import compare, measure, measure_async, print_table, summarize, workspace
+from functions.AsyncDatabase import AsyncDatabase
+from functions.Database import Database
+from functions.GuildDatabases import GuildDatabases
+from functions.Leaderboard import Leaderboard
+from functions.MessageThrottle import MessageThrottle
+from functions.Metrics import metrics
+
+def seed_users(db: Database, count: int, points: int = 0):
+    db.add_points_bulk([(userid, f"user{userid}", points + userid % 1000) for userid in range(1, count + 1)])
+
+def seed_bets(db: Database, pollid: int, count: int, first_userid: int = 1):
+    db.add_poll(pollid, "Benchmark?", "Yes", "No", time.time() + 3600, 1)
+    with db.transaction():
+        db.cursor.executemany('INSERT INTO bets (pollid, userid, option, amount) VALUES (?, ?, ?, ?)', (
+            (pollid, userid, 1 + userid % 2, 10 + userid % 7) for userid in range(first_userid, first_userid + count)
+        ))
+        db.recount_tallies([pollid])
+
+def bench_add_points(sizes):
+    # The bot always keeps the leaderboard loaded, so every write here pays for updating it
+    db = Database("./database/users.db", leaderboard=Leaderboard())
+    db.load_leaderboard()
+    seed_users(db, 1000)
+    rows = [measure("add_points", lambda index: db.add_points(1 + index % 1000, 1), sizes["messages"], users=1000)]
+    awards = [(1 + index % 1000, f"user{1 + index % 1000}", 1) for index in range(sizes["messages"])]
+    batch = 500
+    rows.append(measure(
+        "add_points_bulk", lambda index: db.add_points_bulk(awards[index * batch:(index + 1) * batch]),
+        len(awards) // batch, users=1000, batch=batch,
+    ))
+    db.close_connection()
+    return rows
+
+def bench_add_user_to_poll(sizes):
+    rows = []
+    db = Database("./database/users.db")
+    for pollid, size in enumerate(sizes["poll_sizes"], start=1):
+        seed_bets(db, pollid, size)
+        rows.append(measure(
+            "add_user_to_poll", lambda index: db.add_user_to_poll(size + 1 + index, "Yes", pollid, 10),
+            sizes["bets"], poll_size=size,
+        ))
+    db.close_connection()
+    return rows
+
+def bench_settle_poll(sizes):
+    rows = []
+    db = Database("./database/users.db", leaderboard=Leaderboard())
+    db.load_leaderboard()
+    seed_users(db, max(sizes["table_sizes"]))
+    for size in sizes["poll_sizes"]:
+        pollids = [size * 10 + repeat for repeat in range(3)]
+        for pollid in pollids:
+            seed_bets(db, pollid, size)
+        rows.append(measure("settle_poll", lambda index: db.settle_poll(pollids[index], 1), len(pollids), winners=size // 2, users=max(sizes["table_sizes"])))
+    db.close_connection()
+    return rows
+
+def bench_get_top_users(sizes):
+    rows = []
+    for size in sizes["table_sizes"]:
+        path = f"./database/top{size}.db"
+        db = Database(path)
+        seed_users(db, size)
+        rows.append(measure("get_top_users_sql", lambda index: db.get_top_users(10), sizes["lookups"], users=size))
+        db.leaderboard = Leaderboard()
+        db.load_leaderboard()
+        rows.append(measure("get_top_users_cached", lambda index: db.get_top_users(10), sizes["lookups"], users=size))
+        db.close_connection()
+    return rows
+
+def bench_admin_bulk(sizes):
+    """
+    Granting points to a whole role, one user at a time the way /add-points does it, and in one adjust_points_bulk transaction.
+    Then exporting the users table as CSV.
+    """
+    rows = []
+    db = Database("./database/admin.db")
+    members = [(userid, f"user{userid}", 10) for userid in range(1, sizes["role_size"] + 1)]
+
+    def grant_one_by_one(index):
+        for userid, username, points in members:
+            db.add_user(userid, username)
+            db.add_points(userid, points)
+            db.get_user_points(userid)
+
+    rows.append(measure("role_grant_per_user", grant_one_by_one, 3, members=len(members)))
+    rows.append(measure("role_grant_bulk", lambda index: db.adjust_points_bulk(members), 3, members=len(members)))
+    db.close_connection()
+
+    for size in sizes["table_sizes"]:
+        db = Database(f"./database/export{size}.db")
+        seed_users(db, size)
+        rows.append(measure("export_users_csv", lambda index: db.export_users_csv(f"./database/export{size}.csv"), 3, users=size))
+        db.close_connection()
+    return rows
+
+async def bench_read_during_write(sizes):
+    """
+    Point lookups through AsyncDatabase while the writer thread is stuck in a long transaction.
+    A responsive event loop keeps these close to the idle lookup latency.
+    """
+    db = AsyncDatabase("./database/latency.db")
+    await db.add_points_bulk([(userid, f"user{userid}", 0) for userid in range(1, 1001)])
+    idle = await measure_async("read_idle", lambda index: db.get_user_points(1 + index % 1000), sizes["lookups"])
+
+    def long_write():
+        writer = db.get_connection(False)
+        with writer.transaction():
+            writer.cursor.execute('UPDATE users SET points = points + 1')
+            time.sleep(sizes["write_seconds"])
+
+    loop = asyncio.get_running_loop()
+    write = loop.run_in_executor(db.writer, long_write)
+    await asyncio.sleep(0.01)
+    busy = await measure_async("read_during_write", lambda index: db.get_user_points(1 + index % 1000), sizes["lookups"], write_seconds=sizes["write_seconds"])
+
+    lags = []
+    while not write.done():
+        started = time.perf_counter()
+        await asyncio.sleep(0.001)
+        lags.append(time.perf_counter() - started - 0.001)
+    await write
+    await db.close_connection()
+    return [idle, busy, summarize("loop_lag_during_write", lags, sum(lags) + 0.001 * len(lags))]
+
+async def bench_guild_isolation(sizes):
+    """
+    Writes to one guild while another guild's writer is stuck in a long transaction.
+    Each guild has its own file and writer thread, so these stay close to the idle write latency.
+    """
+    databases = GuildDatabases("./database/isolation")
+    busy_guild, other_guild = databases.get(1), databases.get(2)
+    awards = [(userid, f"user{userid}", 1) for userid in range(1, 1001)]
+    await asyncio.gather(busy_guild.add_points_bulk(awards), other_guild.add_points_bulk(awards))
+    idle = await measure_async("guild_write_idle", lambda index: other_guild.add_points(1 + index % 1000, 1), sizes["lookups"])
+
+    def long_write():
+        writer = busy_guild.get_connection(False)
+        with writer.transaction():
+            writer.cursor.execute('UPDATE users SET points = points + 1')
+            time.sleep(sizes["write_seconds"])
+
+    loop = asyncio.get_running_loop()
+    write = loop.run_in_executor(busy_guild.writer, long_write)
+    await asyncio.sleep(0.01)
+    busy = await measure_async(
+        "guild_write_other_busy", lambda index: other_guild.add_points(1 + index % 1000, 1), sizes["lookups"], write_seconds=sizes["write_seconds"]
+    )
+    await write
+    await databases.close_connection()
+    return [idle, busy]
+
+async def bench_backup(sizes):
+    """
+    Writes through AsyncDatabase while the same database is copied to a snapshot in small page steps.
+    The copy runs on a reader thread, so these stay close to the idle write latency.
+    """
+    databases = GuildDatabases("./database/backup")
+    db = databases.get(1)
+    await db.add_points_bulk([(userid, f"user{userid}", 0) for userid in range(1, sizes["table_sizes"][-1] + 1)])
+    idle = await measure_async("write_idle", lambda index: db.add_points(1 + index % 1000, 1), sizes["lookups"])
+
+    latencies = []
+    started = time.perf_counter()
+    backup = asyncio.create_task(databases.backup(1, pages=64))
+    while not backup.done() or not latencies:
+        write_started = time.perf_counter()
+        await db.add_points(1 + len(latencies) % 1000, 1)
+        latencies.append(time.perf_counter() - write_started)
+    await backup
+    elapsed = time.perf_counter() - started
+    await databases.close_connection()
+    return [idle, summarize("write_during_backup", latencies, elapsed, users=sizes["table_sizes"][-1], backup_ms=round(elapsed * 1000))]
+
+async def bench_cog(sizes):
+    from extensions.Polls import Polls
+
+    bot = FakeBot()
+    cog = Polls(bot)
+    await cog.cog_load()
+    users = [FakeUser(userid) for userid in range(1, 1001)]
+
+    messages = [FakeMessage(users[index % len(users)]) for index in range(sizes["messages"])]
+    rows = [await measure_async("on_message", lambda index: cog.on_message(messages[index]), len(messages), users=len(users))]
+
+    await cog.databases.get(None).add_points_bulk([(user.id, user.name, 1000) for user in users])
+    channel = bot.add_channel(FakeChannel())
+    admin = FakeMember(administrator=True)
+    await cog.create_poll.callback(cog, FakeInteraction(admin), "Benchmark?", "Yes", "No", 1, channel)
+    poll_message = next(iter(channel.messages.values()))
+
+    async def bet(index):
+        user = users[index]
+        click = FakeInteraction(user, message=poll_message, custom_id="poll:1")
+        await cog.poll_button_clicked(1, click)
+        modal = click.response.modal
+        modal.children[0]._value = "10"
+        await modal.on_submit(FakeInteraction(user))
+
+    rows.append(await measure_async("bet_click_and_submit", bet, min(sizes["bets"], len(users)), users=len(users)))
+    rows.append(await measure_async("shop", lambda index: cog.shop.callback(cog, FakeInteraction(users[index % len(users)])), sizes["lookups"]))
+    rows.append(await measure_async(
+        "buy", lambda index: cog.buy.callback(cog, FakeInteraction(users[index % len(users)]), "Test-Item"), sizes["bets"], users=len(users)
+    ))
+    await cog.cog_unload()
+    return rows
+
+async def bench_message_burst(sizes):
+    """
+    A burst of messages arriving at 10k/sec on a simulated clock, half of them from a few spammers.
+    Compares the throttled handler with one awarding every message, and records how many points and database writes each caused.
+    """
+    from extensions.Polls import Polls
+
+    rate = 10000
+    count = int(rate * sizes["burst_seconds"])
+    spammers = [FakeUser(userid) for userid in range(1, 21)]
+    users = [FakeUser(userid) for userid in range(1000, 3000)]
+    messages = [
+        FakeMessage(spammers[index // 2 % len(spammers)] if index % 2 == 0 else users[index // 2 % len(users)])
+        for index in range(count)
+    ]
+
+    rows = []
+    for throttled in (False, True):
+        cog = Polls(FakeBot())
+        await cog.cog_load()
+        clock = [0.0]
+        if throttled:
+            cog.message_throttle.clock = lambda: clock[0]
+        else:
+            cog.message_throttle = MessageThrottle(burst=count, interval=1.0, clock=lambda: clock[0])
+        db = cog.databases.get(None)
+        points_before = sum(points for _, _, points in await db.get_all_users())
+        histogram = metrics.histograms.get("db.add_points_bulk")
+        writes_before = histogram.count if histogram else 0
+
+        async def handle(index):
+            clock[0] = index / rate
+            await cog.on_message(messages[index])
+
+        row = await measure_async("message_burst", handle, count, rate=rate, throttled=throttled)
+        await cog.flush_pending_points(None)
+        awarded = sum(points for _, _, points in await db.get_all_users()) - points_before
+        row["params"].update(awarded=awarded, db_writes=metrics.histograms["db.add_points_bulk"].count - writes_before)
+        rows.append(row)
+        await cog.cog_unload()
+    return rows
+
+SIZES = {
+    "full": {"messages": 20000, "poll_sizes": [1000, 10000, 50000], "bets": 500, "table_sizes": [1000, 10000, 100000], "lookups": 1000, "write_seconds": 1.0, "burst_seconds": 3, "role_size": 1000},
+    "quick": {"messages": 2000, "poll_sizes": [1000, 5000], "bets": 200, "table_sizes": [1000, 10000], "lookups": 200, "write_seconds": 0.3, "burst_seconds": 1, "role_size": 300},
+}
+
+async def run_all(sizes):
+    results = []
+    # The bot's own print() telemetry would drown out the results
+    with workspace(), contextlib.redirect_stdout(io.StringIO()):
+        for bench in (bench_add_points, bench_add_user_to_poll, bench_settle_poll, bench_get_top_users, bench_admin_bulk):
+            results.extend(bench(sizes))
+        results.extend(await bench_read_during_write(sizes))
+        results.extend(await bench_guild_isolation(sizes))
+        results.extend(await bench_backup(sizes))
+        results.extend(await bench_cog(sizes))
+        results.extend(await bench_message_burst(sizes))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--quick", action="store_true", help="use small table sizes")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--compare", help="JSON results of a previous run to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative ops/sec drop, default 0.25")
+    args = parser.parse_args()
+
+    results = asyncio.run(run_all(SIZES["quick" if args.quick else "full"]))
+    print_table(results)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump({
+                "python": platform.python_version(),
+                "sqlite": sqlite3.sqlite_version,
+                "timestamp": time.time(),
+                "results": results,
+            }, file, indent=2)
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.tolerance)
+        for name, params, before, after in regressions:
+            print(f"REGRESSION {name} {params}: {before:.1f} -> {after:.1f} ops/sec")
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+"""
+Replay seeded, realistic traffic against the Polls cog to find where a single process saturates.
+
+Every run builds the same schedule from --seed: Poisson arrivals of messages, bet clicks with their modal submits,
+shop purchases and poll settlements spread over --guilds guilds, plus a storm every second that alternates between
+a flood of messages and a rush of bets on one poll. The schedule is replayed open loop, each event starts at its
+arrival time whether or not earlier ones finished, so latencies include queueing once the bot falls behind.
+After each rate the guild databases are checked: no negative balances, the ledger matches every balance,
+poll tallies match the bets, every pool is paid out in full and no points are created or lost.
+
+Run from the repository root:
+    python -m benchmarks.simulate [--rates 250,500,1000,2000] [--seconds 3] [--seed 1] [--output results.json]
+"""
+import argparse, asyncio, contextlib, io, json, os, platform, random, sqlite3, sys, time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks.fakes import FakeBot, FakeChannel, FakeGuild, FakeInteraction, FakeMember, FakeMessage
+from benchmarks.harness import print_table, summarize, workspace
+from functions.Database import LEDGER_ADMIN, Database
+
+STARTING_POINTS = 500
+SHOP_ITEM = "Test-Item"
+STORM_SECONDS = 0.05
+
+def parse_mix(text: str) -> dict:
+    mix = {}
+    for part in text.split(","):
+        kind, _, weight = part.partition("=")
+        if kind not in ("message", "bet", "buy", "settle"):
+            raise argparse.ArgumentTypeError(f"unknown event kind {kind!r}")
+        mix[kind] = float(weight)
+    return mix
+
+def make_schedule(rng: random.Random, rate: float, args) -> list[tuple]:
+    """
+    Build the events of one run.
+    :param rng: Source of randomness, seeded so every run with the same arguments replays the same traffic.
+    :param rate: Average Poisson arrivals per second, storms come on top.
+    :return: A list of (at, kind, guild index, userid, value) tuples sorted by arrival time in seconds,
+        value is (poll slot, option, amount) for bets, (poll slot, winning option) for settlements and None otherwise.
+    """
+    kinds, weights = zip(*args.mix.items())
+
+    def event(at, kind, guild, slot=None):
+        # Squaring skews activity towards low user IDs, a few users are far more active than the rest
+        userid = 1 + int(args.users * rng.random() ** 2)
+        slot = rng.randrange(args.polls) if slot is None else slot
+        if kind == "bet":
+            return at, kind, guild, userid, (slot, rng.randint(1, 2), rng.randint(1, 50))
+        if kind == "settle":
+            return at, kind, guild, userid, (slot, rng.randint(1, 2))
+        return at, kind, guild, userid, None
+
+    schedule = []
+    at = rng.expovariate(rate)
+    while at < args.seconds:
+        schedule.append(event(at, rng.choices(kinds, weights)[0], rng.randrange(args.guilds)))
+        at += rng.expovariate(rate)
+
+    for second in range(int(args.seconds)):
+        kind = "message" if second % 2 == 0 else "bet"
+        guild, slot = rng.randrange(args.guilds), rng.randrange(args.polls)
+        for _ in range(args.storm):
+            schedule.append(event(second + rng.random() * STORM_SECONDS, kind, guild, slot))
+
+    schedule.sort(key=lambda event: event[0])
+    return schedule
+
+def check(path: str, users: int, placed: int, purchased: int) -> list[str]:
+    """
+    Check the final state of a guild database.
+    :param placed: Bets the cog confirmed to users.
+    :param purchased: Purchases the cog confirmed to users.
+    :return: A description of every broken invariant.
+    """
+    db = Database(path, read_only=True)
+    problems = []
+
+    def scalar(sql: str):
+        db.cursor.execute(sql)
+        return db.cursor.fetchone()[0] or 0
+
+    negative = scalar('SELECT COUNT(*) FROM users WHERE points < 0')
+    if negative:
+        problems.append(f"{negative} users have a negative balance")
+    mismatches = db.verify_balances()
+    if mismatches:
+        problems.append(f"{len(mismatches)} balances differ from the ledger")
+
+    bets = scalar('SELECT COUNT(*) FROM bets')
+    if bets != placed:
+        problems.append(f"{placed} bets confirmed but {bets} recorded")
+    if scalar('SELECT COUNT(*) FROM purchases') != purchased:
+        problems.append(f"{purchased} purchases confirmed but {scalar('SELECT COUNT(*) FROM purchases')} recorded")
+
+    db.cursor.execute('SELECT pollid, option, COUNT(*), SUM(amount) FROM bets GROUP BY pollid, option')
+    counted = {(pollid, option): (bettors, points) for pollid, option, bettors, points in db.cursor.fetchall()}
+    db.cursor.execute('SELECT pollid, first_bettors, first_points, second_bettors, second_points FROM polls')
+    wrong_tallies = sum(
+        (first_bettors, first_points) != counted.get((pollid, 1), (0, 0)) or (second_bettors, second_points) != counted.get((pollid, 2), (0, 0))
+        for pollid, first_bettors, first_points, second_bettors, second_points in db.cursor.fetchall()
+    )
+    if wrong_tallies:
+        problems.append(f"{wrong_tallies} polls have tallies that differ from their bets")
+
+    # A pool goes to the winners in full, or is lost when nobody picked the winning option
+    db.cursor.execute('''
+        SELECT
+            (SELECT COALESCE(SUM(amount), 0) FROM bets WHERE bets.pollid = polls.pollid),
+            (SELECT COUNT(*) FROM bets WHERE bets.pollid = polls.pollid AND option = polls.winning_option),
+            (SELECT COALESCE(SUM(delta), 0) FROM ledger WHERE reason = 'payout' AND reference = polls.pollid)
+        FROM polls WHERE winning_option IS NOT NULL
+    ''')
+    unpaid = lost = 0
+    for staked, winners, paid in db.cursor.fetchall():
+        if paid != (staked if winners else 0):
+            unpaid += 1
+        if not winners:
+            lost += staked
+    if unpaid:
+        problems.append(f"{unpaid} settled polls did not pay out their pool")
+
+    balances = scalar('SELECT SUM(points) FROM users')
+    staked = scalar('SELECT SUM(amount) FROM bets JOIN polls USING (pollid) WHERE winning_option IS NULL')
+    spent = scalar('SELECT SUM(price) FROM purchases')
+    awarded = scalar("SELECT SUM(delta) FROM ledger WHERE reason = 'message'")
+    if balances + staked + spent + lost != users * STARTING_POINTS + awarded:
+        problems.append(
+            f"points not conserved: {balances} in wallets + {staked} staked + {spent} spent + {lost} lost "
+            f"!= {users * STARTING_POINTS} seeded + {awarded} earned"
+        )
+    db.close_connection()
+    return problems
+
+async def simulate(rate: float, args):
+    """
+    Replay one schedule against a fresh cog and database.
+    :return: A (result rows, summary dict) tuple.
+    """
+    from extensions.Polls import Polls
+
+    schedule = make_schedule(random.Random(args.seed), rate, args)
+    bot = FakeBot()
+    cog = Polls(bot)
+    await cog.cog_load()
+    clock = [0.0]
+    cog.message_throttle.clock = lambda: clock[0]
+
+    guilds = [FakeGuild(index + 1) for index in range(args.guilds)]
+    channels = [bot.add_channel(FakeChannel()) for _ in guilds]
+    members = [FakeMember(userid) for userid in range(args.users + 1)]
+    admin = FakeMember(administrator=True)
+    for guild in guilds:
+        await cog.databases.get(guild.id).add_points_bulk([(member.id, member.name, STARTING_POINTS) for member in members[1:]], reason=LEDGER_ADMIN)
+
+    async def create_poll(index: int) -> int:
+        await cog.create_poll.callback(cog, FakeInteraction(admin, guild_id=guilds[index].id), "Simulated?", "Yes", "No", 24, channels[index])
+        return next(reversed(channels[index].messages))
+
+    polls = [[await create_poll(index) for _ in range(args.polls)] for index in range(args.guilds)]
+    outcomes = {index: {"placed": 0, "purchased": 0} for index in range(args.guilds)}
+
+    async def message(guild: int, userid: int, value):
+        await cog.on_message(FakeMessage(members[userid], guild=guilds[guild]))
+
+    async def bet(guild: int, userid: int, value):
+        slot, option, amount = value
+        poll_message = channels[guild].messages[polls[guild][slot]]
+        click = FakeInteraction(members[userid], message=poll_message, custom_id=f"poll:{option}", guild_id=guilds[guild].id)
+        await cog.poll_button_clicked(option, click)
+        if click.response.modal is None:
+            return
+        click.response.modal.children[0]._value = str(amount)
+        submit = FakeInteraction(members[userid], guild_id=guilds[guild].id)
+        await click.response.modal.on_submit(submit)
+        if submit.response.sent[0][0].startswith("You have bet"):
+            outcomes[guild]["placed"] += 1
+
+    async def buy(guild: int, userid: int, value):
+        interaction = FakeInteraction(members[userid], guild_id=guilds[guild].id)
+        await cog.buy.callback(cog, interaction, SHOP_ITEM)
+        if "embed" in interaction.response.sent[0][1]:
+            outcomes[guild]["purchased"] += 1
+
+    async def settle(guild: int, userid: int, value):
+        slot, winner = value
+        pollid = polls[guild][slot]
+        interaction = FakeInteraction(admin, guild_id=guilds[guild].id)
+        await cog.end_poll.callback(cog, interaction, str(pollid))
+        view = interaction.response.sent[0][1].get("view")
+        if view is not None:
+            select = view.children[0]
+            select._values = [select.options[winner - 1].label]
+            await select.callback(FakeInteraction(admin, guild_id=guilds[guild].id))
+        # Another settlement of the same slot may have replaced the poll already
+        if polls[guild][slot] == pollid:
+            polls[guild][slot] = await create_poll(guild)
+
+    handlers = {"message": message, "bet": bet, "buy": buy, "settle": settle}
+    latencies = {kind: [] for kind in handlers}
+    loop = asyncio.get_running_loop()
+
+    async def run(scheduled: float, kind: str, guild: int, userid: int, value):
+        await handlers[kind](guild, userid, value)
+        latencies[kind].append(loop.time() - scheduled)
+
+    pending = []
+    started = loop.time()
+    for at, kind, guild, userid, value in schedule:
+        delay = started + at - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        # The throttle follows the schedule, not the wall clock, so the same messages earn points on every run
+        clock[0] = at
+        pending.append(asyncio.create_task(run(started + at, kind, guild, userid, value)))
+    await asyncio.gather(*pending)
+    elapsed = loop.time() - started
+
+    await cog.cog_unload()
+    problems = []
+    for index, guild in enumerate(guilds):
+        problems.extend(f"guild {guild.id}: {problem}" for problem in check(cog.databases.path(guild.id), args.users, **outcomes[index]))
+
+    rows = [summarize(kind, samples, elapsed, rate=rate) for kind, samples in latencies.items() if samples]
+    everything = [sample for samples in latencies.values() for sample in samples]
+    rows.append(summarize("all", everything, elapsed, rate=rate))
+    summary = {
+        "rate": rate,
+        "offered_per_sec": len(schedule) / args.seconds,
+        "achieved_per_sec": len(schedule) / elapsed,
+        "p99_ms": rows[-1]["p99_ms"],
+        "bets_placed": sum(outcome["placed"] for outcome in outcomes.values()),
+        "problems": problems,
+    }
+    return rows, summary
+
+async def simulate_all(args):
+    rows, summaries = [], []
+    for rate in args.rates:
+        # Each rate gets its own empty database, and the bot's own print() telemetry would drown out the results
+        with workspace(), contextlib.redirect_stdout(io.StringIO()):
+            rate_rows, summary = await simulate(rate, args)
+        rows.extend(rate_rows)
+        summaries.append(summary)
+    return rows, summaries
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rates", type=lambda text: [float(rate) for rate in text.split(",")], default=[250, 500, 1000, 2000], help="comma separated arrivals per second to try")
+    parser.add_argument("--seconds", type=float, default=3, help="length of each run")
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--guilds", type=int, default=2)
+    parser.add_argument("--polls", type=int, default=5, help="open polls per guild, a settled poll is replaced by a new one")
+    parser.add_argument("--storm", type=int, default=200, help="extra events arriving together at the start of every second")
+    parser.add_argument("--mix", type=parse_mix, default="message=85,bet=12,buy=2,settle=1", help="relative weight of each event kind")
+    parser.add_argument("--slo", type=float, default=250, help="p99 latency in ms a rate must stay under to count as sustained")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    rows, summaries = asyncio.run(simulate_all(args))
+    print_table(rows)
+    print()
+
+    sustained = None
+    for summary in summaries:
+        keeps_up = summary["achieved_per_sec"] >= 0.95 * summary["offered_per_sec"] and summary["p99_ms"] <= args.slo
+        if keeps_up and not summary["problems"]:
+            sustained = summary["offered_per_sec"]
+        print(
+            f"rate {summary['rate']:g}: offered {summary['offered_per_sec']:.0f}/s, achieved {summary['achieved_per_sec']:.0f}/s, "
+            f"p99 {summary['p99_ms']:.1f}ms, {summary['bets_placed']} bets placed, {'keeps up' if keeps_up else 'saturated'}"
+        )
+        for problem in summary["problems"]:
+            print(f"FAILED: {problem}")
+    print(f"Highest sustained rate: {sustained:.0f} events/s" if sustained else f"No rate kept up within a {args.slo:g}ms p99")
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump({
+                "python": platform.python_version(),
+                "sqlite": sqlite3.sqlite_version,
+                "timestamp": time.time(),
+                "arguments": {key: value for key, value in vars(args).items() if key != "output"},
+                "results": rows,
+                "summaries": summaries,
+            }, file, indent=2)
+
+    if any(summary["problems"] for summary in summaries):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Fire thousands of simultaneous bets and check that no balance goes negative and no points are created or lost.
+
+Bets go through AsyncDatabase the way the bot places them, and then through several independent writer
+connections on their own threads, which is the worst case for the conditional debit.
+
+Run from the repository root:
+    python -m benchmarks.stress_bets [--bets 5000] [--users 300] [--seed 1]
+"""
+import argparse, asyncio, os, random, sys, threading, time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks.harness import workspace
+from functions.AsyncDatabase import AsyncDatabase
+from functions.Database import BET_PLACED, Database
+
+POLLS = 5
+STARTING_POINTS = 100
+
+def make_bets(rng: random.Random, count: int, users: int, first_pollid: int):
+    # Many users bet more than they have across polls, and many bets repeat a (user, poll) pair
+    return [
+        (rng.randint(1, users), first_pollid + rng.randrange(POLLS), rng.randint(1, 2), rng.randint(1, 60))
+        for _ in range(count)
+    ]
+
+def check(path: str, users: int, placed: int) -> list[str]:
+    db = Database(path, read_only=True)
+    problems = []
+    db.cursor.execute('SELECT COUNT(*) FROM users WHERE points < 0')
+    negative = db.cursor.fetchone()[0]
+    if negative:
+        problems.append(f"{negative} users have a negative balance")
+
+    db.cursor.execute('SELECT COALESCE(SUM(points), 0) FROM users')
+    balances = db.cursor.fetchone()[0]
+    db.cursor.execute('SELECT COALESCE(SUM(amount), 0), COUNT(*) FROM bets')
+    staked, bets = db.cursor.fetchone()
+    if balances + staked != users * STARTING_POINTS:
+        problems.append(f"points not conserved: {balances} in wallets + {staked} staked != {users * STARTING_POINTS}")
+    if bets != placed:
+        problems.append(f"{placed} bets reported as placed but {bets} recorded")
+    mismatches = db.verify_balances()
+    if mismatches:
+        problems.append(f"{len(mismatches)} balances differ from the ledger")
+    db.close_connection()
+    return problems
+
+async def stress_async(rng: random.Random, count: int, users: int) -> int:
+    db = AsyncDatabase("./database/users.db")
+    for pollid in range(1, POLLS + 1):
+        await db.add_poll(pollid, "Stress?", "Yes", "No", time.time() + 3600, 1)
+
+    bets = make_bets(rng, count, users, 1)
+    started = time.perf_counter()
+    results = await asyncio.gather(*(db.place_bet(userid, pollid, option, amount) for userid, pollid, option, amount in bets))
+    elapsed = time.perf_counter() - started
+    await db.close_connection()
+
+    placed = results.count(BET_PLACED)
+    print(f"asyncdatabase: {count} bets in {elapsed:.2f}s ({count / elapsed:.0f}/s), {placed} placed")
+    return placed
+
+def stress_threads(rng: random.Random, count: int, users: int, threads: int) -> int:
+    setup = Database("./database/users.db")
+    for pollid in range(POLLS + 1, 2 * POLLS + 1):
+        setup.add_poll(pollid, "Stress?", "Yes", "No", time.time() + 3600, 1)
+    setup.close_connection()
+
+    bets = make_bets(rng, count, users, POLLS + 1)
+    placed = []
+    barrier = threading.Barrier(threads)
+
+    def worker(chunk):
+        db = Database("./database/users.db")
+        barrier.wait()
+        placed.append(sum(db.place_bet(*bet) == BET_PLACED for bet in chunk))
+        db.close_connection()
+
+    started = time.perf_counter()
+    workers = [threading.Thread(target=worker, args=(bets[index::threads],)) for index in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    print(f"{threads} writer connections: {count} bets in {elapsed:.2f}s ({count / elapsed:.0f}/s), {sum(placed)} placed")
+    return sum(placed)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bets", type=int, default=5000)
+    parser.add_argument("--users", type=int, default=300)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    with workspace():
+        db = Database("./database/users.db")
+        db.add_points_bulk([(userid, f"user{userid}", STARTING_POINTS) for userid in range(1, args.users + 1)])
+        db.close_connection()
+
+        placed = asyncio.run(stress_async(rng, args.bets, args.users))
+        placed += stress_threads(rng, args.bets, args.users, args.threads)
+        problems = check("./database/users.db", args.users, placed)
+
+    for problem in problems:
+        print(f"FAILED: {problem}")
+    if problems:
+        sys.exit(1)
+    print("OK: no negative balances, every point accounted for and the ledger matches")
+
+if __name__ == "__main__":
+    main()
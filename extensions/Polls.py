@@ -1,30 +1,377 @@
 import discord
-import dotenv, os, time
+import asyncio, csv, datetime, dotenv, functools, heapq, io, os, sqlite3, tempfile, time
 from discord import app_commands
-from discord.ext import commands
-from functions.Database import Database
+from discord.ext import commands, tasks
+from functions.AsyncDatabase import AsyncDatabase
+from functions.Database import BET_CLOSED, BET_DUPLICATE, BET_INSUFFICIENT
+from functions.GuildDatabases import GuildDatabases
+from functions.MessageThrottle import MessageThrottle
+from functions.Metrics import metrics
+from functions.PointsBuffer import PointsBuffer
+from functions.PollTallies import PollTallies
+from functions.ShopCatalog import ShopCatalog
 
 dotenv.load_dotenv()
 MESSAGE_POINTS = int(os.getenv("MESSAGE_POINTS", 1))
+MESSAGE_FLUSH_INTERVAL = float(os.getenv("MESSAGE_FLUSH_INTERVAL", 5))
+MESSAGE_FLUSH_SIZE = int(os.getenv("MESSAGE_FLUSH_SIZE", 500))
+# Each user can earn points for MESSAGE_AWARD_BURST messages in a row, then one more every MESSAGE_AWARD_INTERVAL seconds
+MESSAGE_AWARD_BURST = int(os.getenv("MESSAGE_AWARD_BURST", 5))
+MESSAGE_AWARD_INTERVAL = float(os.getenv("MESSAGE_AWARD_INTERVAL", 10))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 100000))
+DATABASE_DIRECTORY = os.getenv("DATABASE_DIRECTORY", "./database")
+DATABASE_READERS = int(os.getenv("DATABASE_READERS", 4))
+# Seconds a guild's database stays open without being used, 0 keeps every database open
+DATABASE_IDLE_TIMEOUT = float(os.getenv("DATABASE_IDLE_TIMEOUT", 600))
+# The guild whose data is in users.db, from before each guild had its own database
+DEFAULT_GUILD_ID = int(os.getenv("DEFAULT_GUILD_ID", 0)) or None
+POLL_REFRESH_INTERVAL = float(os.getenv("POLL_REFRESH_INTERVAL", 5))
+POLL_REFRESH_LIMIT = int(os.getenv("POLL_REFRESH_LIMIT", 5))
+# Seconds before closing the expired polls of a guild is tried again after it failed
+POLL_EXPIRY_RETRY = float(os.getenv("POLL_EXPIRY_RETRY", 60))
+LEDGER_CHECKPOINT_INTERVAL = float(os.getenv("LEDGER_CHECKPOINT_INTERVAL", 3600))
+# Snapshots of every open guild database go to DATABASE_DIRECTORY/backups, 0 turns them off
+BACKUP_INTERVAL = float(os.getenv("BACKUP_INTERVAL", 21600))
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", 4))
+BACKUP_PAGES = int(os.getenv("BACKUP_PAGES", 1024))
+# Pruning, vacuuming and analyzing run once a day at this UTC hour, pick one with little traffic
+MAINTENANCE_HOUR = int(os.getenv("MAINTENANCE_HOUR", 4))
+POLL_RETENTION_DAYS = float(os.getenv("POLL_RETENTION_DAYS", 30))
+POLL_IMAGE_URL = "https://www.ovationmr.com/wp-content/uploads/2021/09/Poll-vs.-Survey.webp"
 
 class Polls(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.db = Database("./database/users.db")
-        self.shop_items = []
-        with open("./database/shop.txt", "r") as file:
-            all_data = file.readlines()
-            self.shop_items = [
-                {"name": item.split(":")[0], "price": int(item.split(":")[1])} for item in all_data
-            ]
+        self.databases = GuildDatabases(DATABASE_DIRECTORY, DEFAULT_GUILD_ID, readers=DATABASE_READERS, cache_size=USER_CACHE_SIZE)
+        self.points_buffers = {}
+        # Guilds whose database was closed for being idle since their last backup or maintenance run
+        self.backup_pending = set()
+        self.maintenance_pending = set()
+        self.message_throttle = MessageThrottle(burst=MESSAGE_AWARD_BURST, interval=MESSAGE_AWARD_INTERVAL)
+        self.active_polls = {}
+        self.poll_guilds = {}
+        self.expiry_heap = []
+        self.expiry_wakeup = asyncio.Event()
+        self.expiry_retries = set()
+        self.expiry_retry_at = None
+        self.expiry_task = None
+        self.polls_loaded = None
+        self.poll_tallies = PollTallies()
+        self.shop_catalog = ShopCatalog("./database/shop.txt")
+        self.shop_embed = None
+        self.shop_embed_version = None
+
+    async def cog_load(self):
+        # Without DEFAULT_GUILD_ID every guild gets a file of its own, and balances and polls from before that belong to none of them
+        if DEFAULT_GUILD_ID is None and self.databases.legacy_default_file():
+            raise RuntimeError(
+                f"{self.databases.path(None)} holds balances and polls from before every guild had its own database, "
+                "set DEFAULT_GUILD_ID to the ID of the guild they belong to"
+            )
+        self.flush_points.change_interval(seconds=MESSAGE_FLUSH_INTERVAL)
+        self.flush_points.start()
+        # Loading polls runs alongside the gateway login, the only thing that needs them is a click on a poll
+        self.polls_loaded = asyncio.create_task(self.load_all_active_polls())
+        self.expiry_task = asyncio.create_task(self.run_expiry_scheduler())
+        self.refresh_polls.change_interval(seconds=POLL_REFRESH_INTERVAL)
+        self.refresh_polls.start()
+        self.checkpoint_ledger.change_interval(seconds=LEDGER_CHECKPOINT_INTERVAL)
+        self.checkpoint_ledger.start()
+        if BACKUP_INTERVAL:
+            self.backup_databases.change_interval(seconds=BACKUP_INTERVAL)
+            self.backup_databases.start()
+        self.maintain_databases.change_interval(time=datetime.time(hour=MAINTENANCE_HOUR, tzinfo=datetime.timezone.utc))
+        self.maintain_databases.start()
+        if DATABASE_IDLE_TIMEOUT:
+            self.close_idle_databases.start()
+
+    async def cog_unload(self):
+        self.flush_points.cancel()
+        self.refresh_polls.cancel()
+        self.checkpoint_ledger.cancel()
+        self.backup_databases.cancel()
+        self.maintain_databases.cancel()
+        self.close_idle_databases.cancel()
+        if self.expiry_task is not None:
+            self.expiry_task.cancel()
+        if self.polls_loaded is not None:
+            self.polls_loaded.cancel()
+        await asyncio.gather(*(self.flush_pending_points(guild_id) for guild_id in list(self.points_buffers)))
+        await self.databases.close_connection()
+
+    async def flush_pending_points(self, guild_id: int):
+        points_buffer = self.points_buffers.get(guild_id)
+        awards = points_buffer.drain() if points_buffer is not None else None
+        if awards:
+            try:
+                await self.databases.get(guild_id).add_points_bulk(awards)
+            except Exception:
+                # The batch was rolled back as a whole, so the awards go back for the next flush
+                points_buffer.restore(awards)
+                raise
+
+    @tasks.loop(seconds=5)
+    async def flush_points(self):
+        # Every guild has its own writer, so the flushes run side by side.
+        # tasks.loop stops on any error it doesn't retry itself, so a failing guild is reported here and retried next time.
+        guild_ids = list(self.points_buffers)
+        results = await asyncio.gather(*(self.flush_pending_points(guild_id) for guild_id in guild_ids), return_exceptions=True)
+        for guild_id, result in zip(guild_ids, results):
+            if isinstance(result, sqlite3.Error):
+                metrics.increment("flush_points.errors")
+                print(f"Flushing points of guild {guild_id} failed: {result}")
+            elif isinstance(result, BaseException):
+                raise result
+
+    @tasks.loop(seconds=3600)
+    async def checkpoint_ledger(self):
+        # Replaying balances starts from the latest checkpoint, so this bounds how much of the ledger a replay reads
+        for guild_id, db in self.databases.items():
+            try:
+                last_entry, checkpointed = await db.ledger_position()
+                if last_entry > checkpointed:
+                    await db.checkpoint_balances()
+            except sqlite3.Error as error:
+                metrics.increment("maintenance.checkpoint.errors")
+                print(f"Checkpointing the ledger of guild {guild_id} failed: {error}")
+
+    @tasks.loop(seconds=21600)
+    async def backup_databases(self):
+        # The copy reads a few pages per step on a reader thread, writes carry on between steps.
+        # tasks.loop also runs right after every restart, going by the newest snapshot keeps a crash loop or
+        # a string of redeploys from replacing every older snapshot. The margin covers an iteration running a little early.
+        # Guilds closed for being idle are backed up once more, the snapshot then holds everything they wrote.
+        for guild_id in {guild_id for guild_id, _ in self.databases.items()} | self.backup_pending:
+            age = self.databases.backup_age(guild_id)
+            if age is not None and age < BACKUP_INTERVAL * 0.9:
+                continue
+            try:
+                await self.databases.backup(guild_id, keep=BACKUP_KEEP, pages=BACKUP_PAGES)
+                self.backup_pending.discard(guild_id)
+            except (OSError, sqlite3.Error) as error:
+                metrics.increment("maintenance.backup.errors")
+                print(f"Backup of guild {guild_id} failed: {error}")
+
+    @tasks.loop(time=datetime.time(hour=4, tzinfo=datetime.timezone.utc))
+    async def maintain_databases(self):
+        # Pruning goes in batches, so bets and flushes queued on the writer only ever wait for one batch
+        cutoff = time.time() - POLL_RETENTION_DAYS * 86400
+        # Held for the whole run, so close_idle_databases can't close the database between two steps
+        for guild_id in {guild_id for guild_id, _ in self.databases.items()} | self.maintenance_pending:
+            try:
+                with self.databases.hold(guild_id) as db:
+                    while True:
+                        polls, bets = await db.prune_polls(cutoff, limit=500)
+                        metrics.increment("maintenance.pruned_polls", polls)
+                        metrics.increment("maintenance.pruned_bets", bets)
+                        if polls < 500:
+                            break
+                    await db.compact()
+                    await db.analyze()
+                self.maintenance_pending.discard(guild_id)
+            except sqlite3.Error as error:
+                metrics.increment("maintenance.errors")
+                print(f"Maintenance of guild {guild_id} failed: {error}")
+
+    @tasks.loop(seconds=60)
+    async def close_idle_databases(self):
+        # Every open guild holds a writer thread and a few file descriptors, so a guild that has gone quiet gives them back.
+        # Its buffered points and ledger are written out first, a guild used again meanwhile is left open.
+        for guild_id, db in self.databases.idle(DATABASE_IDLE_TIMEOUT):
+            try:
+                for buffered_guild_id in list(self.points_buffers):
+                    if self.databases.path(buffered_guild_id) == self.databases.path(guild_id):
+                        await self.flush_pending_points(buffered_guild_id)
+                        if not self.points_buffers[buffered_guild_id]:
+                            del self.points_buffers[buffered_guild_id]
+                last_entry, checkpointed = await db.ledger_position()
+                if last_entry > checkpointed:
+                    await db.checkpoint_balances()
+            except sqlite3.Error as error:
+                metrics.increment("maintenance.close.errors")
+                print(f"Closing the database of guild {guild_id} failed: {error}")
+                continue
+            # Only a guild that used its database has anything new to back up, one opened just for housekeeping doesn't
+            used = guild_id in self.databases.used
+            if await self.databases.close(guild_id, idle=DATABASE_IDLE_TIMEOUT):
+                metrics.increment("maintenance.closed_databases")
+                if used:
+                    self.backup_pending.add(guild_id)
+                    self.maintenance_pending.add(guild_id)
+
+    @metrics.timed("startup.load_polls")
+    async def load_all_active_polls(self):
+        await asyncio.gather(*(self.load_active_polls(guild_id) for guild_id in self.databases.stored_guilds()))
+
+    async def load_active_polls(self, guild_id: int):
+        db = self.databases.get(guild_id)
+        active_polls = await db.get_active_polls()
+        for pollid, expiry_time in active_polls:
+            self.track_poll(pollid, expiry_time, guild_id)
+        # Closed polls still have to be ended, so the guild holding them is remembered until they are paid out
+        for pollid in await db.get_unsettled_polls():
+            self.poll_guilds[pollid] = guild_id
+        await asyncio.gather(*(self.load_poll_tallies(db, pollid) for pollid, _ in active_polls))
+
+    def track_poll(self, pollid: int, expiry_time: float, guild_id: int):
+        self.active_polls[pollid] = expiry_time
+        self.poll_guilds[pollid] = guild_id
+        heapq.heappush(self.expiry_heap, (expiry_time, pollid))
+        self.expiry_wakeup.set()
+
+    async def load_poll_tallies(self, db: AsyncDatabase, pollid: int):
+        poll = await db.get_poll(pollid)
+        totals = await db.get_poll_tallies(pollid)
+        if poll is not None:
+            question, first_option, second_option, _, _, channel_id = poll
+            self.poll_tallies.track(pollid, question, first_option, second_option, channel_id, totals)
+
+    def poll_embed(self, question: str, first_option: str, second_option: str, totals=None) -> discord.Embed:
+        """
+        Build the embed of a poll message.
+        :param question: The question of the poll.
+        :param first_option: The label of the first option.
+        :param second_option: The label of the second option.
+        :param totals: The running totals, a dict mapping each option to a (bettors, points) pair.
+        """
+        totals = totals or {1: (0, 0), 2: (0, 0)}
+        pool = totals[1][1] + totals[2][1]
+        embed = discord.Embed(title=question, description=None, color=discord.Color.blurple())
+        for option, label in ((1, first_option), (2, second_option)):
+            bettors, points = totals[option]
+            # Winners share the whole pool in proportion to their bets, so each point on this option returns pool / points
+            odds = f", pays `x{pool / points:.2f}`" if points else ""
+            embed.add_field(name=f"Option {option}:", value=f"{label}\n`{bettors}` bettors, `{points}` points{odds}", inline=False)
+        embed.set_image(url=POLL_IMAGE_URL)
+        return embed
+
+    @tasks.loop(seconds=5)
+    async def refresh_polls(self):
+        # Bets only mark their poll as changed, so a burst of bets costs one edit per poll per interval.
+        # The limit spreads edits over several intervals when many polls change at once.
+        for pollid in self.poll_tallies.drain_changed(POLL_REFRESH_LIMIT):
+            poll = self.poll_tallies.get(pollid)
+            # Ending or expiring a poll during an earlier edit forgets it, its buttons are already disabled
+            if poll is None:
+                continue
+            channel = self.bot.get_channel(poll["channel_id"]) if poll["channel_id"] else None
+            if channel is None:
+                continue
+
+            embed = self.poll_embed(poll["question"], poll["options"][1], poll["options"][2], poll["totals"])
+            try:
+                await channel.get_partial_message(pollid).edit(embed=embed)
+                metrics.increment("poll.refresh")
+            except (discord.NotFound, discord.Forbidden):
+                self.poll_tallies.forget(pollid)
+            except discord.HTTPException as error:
+                # discord.py already waited out the rate limit and gave up, try again next interval and stop for now
+                self.poll_tallies.mark_changed(pollid)
+                metrics.increment("poll.refresh.errors")
+                if error.status == 429:
+                    break
+
+    def poll_in_guild(self, pollid: int, channel_id: int, guild_id: int) -> bool:
+        # A poll is looked up in the file it was loaded from, which admins of another guild must not reach by its ID
+        if self.databases.path(self.poll_guilds.get(pollid, guild_id)) == self.databases.path(guild_id):
+            return True
+        channel = self.bot.get_channel(channel_id) if channel_id else None
+        return getattr(channel, "guild", None) is not None and channel.guild.id == guild_id
+
+    def poll_accepting_bets(self, pollid: int) -> bool:
+        return self.active_polls.get(pollid, 0) > time.time()
+
+    async def run_expiry_scheduler(self):
+        await self.bot.wait_until_ready()
+        while True:
+            self.expiry_wakeup.clear()
+            delay = self.expiry_heap[0][0] - time.time() if self.expiry_heap else None
+            if self.expiry_retries:
+                retry_delay = self.expiry_retry_at - time.time()
+                delay = retry_delay if delay is None else min(delay, retry_delay)
+            if delay is None or delay > 0:
+                try:
+                    await asyncio.wait_for(self.expiry_wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            now = time.time()
+            expired_guilds = set()
+            if self.expiry_retries and self.expiry_retry_at <= now:
+                expired_guilds, self.expiry_retries = self.expiry_retries, set()
+            while self.expiry_heap and self.expiry_heap[0][0] <= now:
+                expiry_time, pollid = heapq.heappop(self.expiry_heap)
+                if self.active_polls.get(pollid) == expiry_time:
+                    del self.active_polls[pollid]
+                    expired_guilds.add(self.poll_guilds[pollid])
+
+            # An error ending this task would leave every later poll open, so a failing guild is reported and tried again later.
+            # Its expired polls are already out of active_polls, so they take no bets in the meantime.
+            for guild_id in expired_guilds:
+                try:
+                    expired = await self.databases.get(guild_id).close_expired_polls(now)
+                except Exception as error:
+                    metrics.increment("expiry.errors")
+                    print(f"Closing expired polls of guild {guild_id} failed: {error}")
+                    self.expiry_retries.add(guild_id)
+                    self.expiry_retry_at = now + POLL_EXPIRY_RETRY
+                    continue
+                for pollid, channel_id, first_option, second_option in expired:
+                    try:
+                        await self.disable_poll_buttons(pollid, channel_id, first_option, second_option)
+                    except Exception as error:
+                        metrics.increment("expiry.errors")
+                        print(f"Disabling the buttons of poll {pollid} failed: {error}")
+
+    async def disable_poll_buttons(self, pollid: int, channel_id: int, first_option: str, second_option: str):
+        poll = self.poll_tallies.forget(pollid)
+        channel = self.bot.get_channel(channel_id) if channel_id else None
+        if channel is None:
+            return
+
+        view = PollView(self, first_option, second_option, disabled=True)
+        view.stop()
+        # The final totals go out with the disabled buttons, in case the last bets were not shown yet
+        edit = {"view": view}
+        if poll is not None:
+            edit["embed"] = self.poll_embed(poll["question"], first_option, second_option, poll["totals"])
+        try:
+            await channel.get_partial_message(pollid).edit(**edit)
+        except discord.HTTPException:
+            pass
+
+    @metrics.timed("button.poll")
+    async def poll_button_clicked(self, option: int, interaction: discord.Interaction):
+        poll_id = interaction.message.id
+        await self.polls_loaded
+        if not self.poll_accepting_bets(poll_id):
+            return await interaction.response.send_message(content="The Poll Has Expired!", ephemeral=True)
+
+        # The poll's own database, which is not the guild's file for polls created before every guild had one
+        db = self.databases.get(self.poll_guilds.get(poll_id, interaction.guild_id))
+        await self.flush_pending_points(interaction.guild_id)
+        await db.add_user(userid=interaction.user.id, username=interaction.user.name)
+        option_label = next(
+            child.label
+            for row in interaction.message.components
+            for child in row.children
+            if child.custom_id == interaction.data["custom_id"]
+        )
+
+        value_modal = ValueModal(option=option, option_label=option_label, cog=self, guild_id=self.poll_guilds.get(poll_id, interaction.guild_id), pollid=poll_id)
+        await interaction.response.send_modal(value_modal)
 
     @app_commands.command(name="points", description="Check the amount of points in your wallet.")
+    @metrics.timed("command.points")
     async def points(self, interaction: discord.Interaction, user: discord.User = None):
         if user is None:
             user = interaction.user
 
-        self.db.add_user(userid=user.id, username=user.name)
-        points = self.db.get_user_points(userid=user.id)
+        db = self.databases.get(interaction.guild_id)
+        await self.flush_pending_points(interaction.guild_id)
+        await db.add_user(userid=user.id, username=user.name)
+        points = await db.get_user_points(userid=user.id)
 
         embed = discord.Embed(title="User Points", description=None, color=discord.Color.blurple())
         embed.add_field(name="Userid:", value=f"`{user.id}`", inline=False)
@@ -35,11 +382,14 @@ class Polls(commands.Cog):
 
     @commands.has_permissions(administrator=True)
     @app_commands.command(name="add-points", description="For admins to add points to users.")
+    @metrics.timed("command.add-points")
     async def add_points(self, interaction: discord.Interaction, user: discord.User, points: int):
-        self.db.add_user(userid=user.id, username=user.name)
-        self.db.add_points(userid=user.id, points=points)
+        await self.flush_pending_points(interaction.guild_id)
+        db = self.databases.get(interaction.guild_id)
+        await db.add_user(userid=user.id, username=user.name)
+        await db.add_points(userid=user.id, points=points)
 
-        points = self.db.get_user_points(userid=user.id)
+        points = await db.get_user_points(userid=user.id)
 
         embed = discord.Embed(title="User Points Addition", description=None, color=discord.Color.blurple())
         embed.add_field(name="Userid:", value=f"`{user.id}`", inline=False)
@@ -50,11 +400,14 @@ class Polls(commands.Cog):
 
     @commands.has_permissions(administrator=True)
     @app_commands.command(name="rem-points", description="For admins to remove points from users.")
+    @metrics.timed("command.rem-points")
     async def rem_points(self, interaction: discord.Interaction, user: discord.User, points: int):
-        self.db.add_user(userid=user.id, username=user.name)
-        self.db.remove_points(userid=user.id, points=points)
+        await self.flush_pending_points(interaction.guild_id)
+        db = self.databases.get(interaction.guild_id)
+        await db.add_user(userid=user.id, username=user.name)
+        await db.remove_points(userid=user.id, points=points)
 
-        points = self.db.get_user_points(userid=user.id)
+        points = await db.get_user_points(userid=user.id)
 
         embed = discord.Embed(title="User Points Removal", description=None, color=discord.Color.blurple())
         embed.add_field(name="Userid:", value=f"`{user.id}`", inline=False)
@@ -63,30 +416,159 @@ class Polls(commands.Cog):
 
         await interaction.response.send_message(embed=embed)
 
+    @commands.has_permissions(administrator=True)
+    @app_commands.command(name="add-points-role", description="For admins to add points to every member of a role.")
+    @metrics.timed("command.add-points-role")
+    async def add_points_role(self, interaction: discord.Interaction, role: discord.Role, points: app_commands.Range[int, 1]):
+        adjustments = [(member.id, member.name, points) for member in role.members if not member.bot]
+        await self.adjust_points(interaction, adjustments, f"Added {points} points to {role.name}")
+
+    @commands.has_permissions(administrator=True)
+    @app_commands.command(name="rem-points-role", description="For admins to remove points from every member of a role.")
+    @metrics.timed("command.rem-points-role")
+    async def rem_points_role(self, interaction: discord.Interaction, role: discord.Role, points: app_commands.Range[int, 1]):
+        adjustments = [(member.id, member.name, -points) for member in role.members if not member.bot]
+        await self.adjust_points(interaction, adjustments, f"Removed {points} points from {role.name}")
+
+    @commands.has_permissions(administrator=True)
+    @app_commands.command(name="import-points", description="For admins to add or remove points from a CSV of userid,points rows.")
+    @metrics.timed("command.import-points")
+    async def import_points(self, interaction: discord.Interaction, file: discord.Attachment):
+        try:
+            adjustments = self.parse_points_csv((await file.read()).decode("utf-8-sig"), interaction.guild)
+        except (UnicodeDecodeError, ValueError) as error:
+            await interaction.response.send_message(content=f"Invalid CSV file: {error}", ephemeral=True)
+            return
+        await self.adjust_points(interaction, adjustments, f"Imported {file.filename}")
+
+    def parse_points_csv(self, text: str, guild: discord.Guild):
+        """
+        Parse point adjustments from CSV rows of userid,points, a header row and a trailing username column are optional.
+        :param text: The contents of the CSV file.
+        :param guild: The guild the points are for, used to name users that don't exist yet.
+        :return: A list of (userid, username, points) tuples.
+        """
+        adjustments = []
+        for line, row in enumerate(csv.reader(io.StringIO(text)), start=1):
+            if not row or (line == 1 and not row[0].strip().isdigit()):
+                continue
+            try:
+                userid, points = int(row[0]), int(row[1])
+            except (IndexError, ValueError):
+                raise ValueError(f"line {line} is not a userid,points row")
+            username = row[2].strip() if len(row) > 2 and row[2].strip() else None
+            if username is None:
+                member = guild.get_member(userid) if guild is not None else None
+                username = member.name if member is not None else str(userid)
+            adjustments.append((userid, username, points))
+        return adjustments
+
+    async def adjust_points(self, interaction: discord.Interaction, adjustments, title: str):
+        if not interaction.user.guild_permissions.administrator:
+            await interaction.response.send_message(content="You don't have the required permissions to perform this action.", ephemeral=True)
+            return
+
+        # Every adjustment is written in one transaction on the guild's writer
+        await interaction.response.defer(ephemeral=True)
+        await self.flush_pending_points(interaction.guild_id)
+        skipped = await self.databases.get(interaction.guild_id).adjust_points_bulk(adjustments)
+
+        embed = discord.Embed(title=title, description=None, color=discord.Color.blurple())
+        embed.add_field(name="Users Updated:", value=f"`{len(adjustments) - len(skipped)}`", inline=False)
+        if skipped:
+            embed.add_field(name="Skipped, Not Enough Points:", value=f"`{len(skipped)}`", inline=False)
+        await interaction.followup.send(embed=embed, ephemeral=True)
+
+    @commands.has_permissions(administrator=True)
+    @app_commands.command(name="export-points", description="For admins to download every user's points as a CSV file.")
+    @metrics.timed("command.export-points")
+    async def export_points(self, interaction: discord.Interaction):
+        if not interaction.user.guild_permissions.administrator:
+            await interaction.response.send_message(content="You don't have the required permissions to perform this action.", ephemeral=True)
+            return
+
+        await interaction.response.defer(ephemeral=True)
+        await self.flush_pending_points(interaction.guild_id)
+        # Rows are streamed from SQLite straight into a temporary file on a reader thread
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "points.csv")
+            count = await self.databases.get(interaction.guild_id).export_users_csv(path)
+            await interaction.followup.send(content=f"Exported {count} users.", file=discord.File(path, filename="points.csv"), ephemeral=True)
+
     @app_commands.command(name="shop", description="Display shop prices.")
+    @metrics.timed("command.shop")
     async def shop(self, interaction: discord.Interaction):
-        embed = discord.Embed(title="Shop Prices", color=discord.Color.green())
-        for item in self.shop_items:
-            embed.add_field(name=item["name"], value=f"{item['price']} points", inline=False)
+        await interaction.response.send_message(embed=self.get_shop_embed())
+
+    def get_shop_embed(self) -> discord.Embed:
+        # The embed is only rebuilt when the shop file was edited, otherwise every /shop sends the same one
+        self.shop_catalog.refresh()
+        if self.shop_embed_version != self.shop_catalog.version:
+            embed = discord.Embed(title="Shop Prices", color=discord.Color.green())
+            for item in self.shop_catalog.all()[:25]:
+                embed.add_field(name=item["name"], value=f"{item['price']} points", inline=False)
+            self.shop_embed = embed
+            self.shop_embed_version = self.shop_catalog.version
+        return self.shop_embed
+
+    @app_commands.command(name="buy", description="Buy an item from the shop with your points.")
+    @metrics.timed("command.buy")
+    async def buy(self, interaction: discord.Interaction, item: str):
+        self.shop_catalog.refresh()
+        shop_item = self.shop_catalog.get(item)
+        if shop_item is None:
+            await interaction.response.send_message("Item not found.", ephemeral=True)
+            return
+
+        db = self.databases.get(interaction.guild_id)
+        await self.flush_pending_points(interaction.guild_id)
+        await db.add_user(userid=interaction.user.id, username=interaction.user.name)
+        points = await db.purchase(userid=interaction.user.id, item=shop_item["name"], price=shop_item["price"])
+        if points is None:
+            await interaction.response.send_message(content="You don't have enough points to perform this action.", ephemeral=True)
+            return
+
+        embed = discord.Embed(title="Item Purchased", description=None, color=discord.Color.green())
+        embed.add_field(name="Item:", value=f"`{shop_item['name']}`", inline=False)
+        embed.add_field(name="Price:", value=f"`{shop_item['price']}`", inline=False)
+        embed.add_field(name="Points Left:", value=f"`{points}`", inline=False)
 
         await interaction.response.send_message(embed=embed)
 
+    @buy.autocomplete("item")
+    async def buy_item_autocomplete(self, interaction: discord.Interaction, current: str):
+        current = current.lower()
+        return [
+            app_commands.Choice(name=f"{item['name']} ({item['price']} points)", value=item["name"])
+            for item in self.shop_catalog.all()
+            if current in item["name"].lower()
+        ][:25]
+
     @commands.Cog.listener()
+    @metrics.timed("listener.on_message")
     async def on_message(self, message):
         if message.author.bot:
             return
 
         user_id = message.author.id
         username = message.author.name
+        guild_id = message.guild.id if message.guild is not None else None
 
-        self.db.add_user(user_id, username)
-        self.db.add_points(user_id, MESSAGE_POINTS)  # Add points for each message
+        # Points for each message are buffered per guild and written in batches, messages over the throttle cost nothing
+        if self.message_throttle.allow((guild_id, user_id)):
+            points_buffer = self.points_buffers.get(guild_id)
+            if points_buffer is None:
+                points_buffer = self.points_buffers[guild_id] = PointsBuffer(max_size=MESSAGE_FLUSH_SIZE)
+            if points_buffer.add(user_id, username, MESSAGE_POINTS):
+                await self.flush_pending_points(guild_id)
 
         await self.bot.process_commands(message)
         
     @app_commands.command(name="leaderboard", description="Display the top 10 users by points.")
+    @metrics.timed("command.leaderboard")
     async def leaderboard(self, interaction: discord.Interaction):
-        top_users = self.db.get_top_users(limit=10)
+        await self.flush_pending_points(interaction.guild_id)
+        top_users = await self.databases.get(interaction.guild_id).get_top_users(limit=10)
         if not top_users:
             await interaction.response.send_message("No users found.", ephemeral=True)
             return
@@ -97,26 +579,54 @@ class Polls(commands.Cog):
 
         await interaction.response.send_message(embed=embed)
 
+    @app_commands.command(name="rank", description="Check your position on the leaderboard.")
+    @metrics.timed("command.rank")
+    async def rank(self, interaction: discord.Interaction, user: discord.User = None):
+        if user is None:
+            user = interaction.user
+
+        await self.flush_pending_points(interaction.guild_id)
+        rank = await self.databases.get(interaction.guild_id).get_user_rank(userid=user.id)
+        if rank is None:
+            await interaction.response.send_message("User not found.", ephemeral=True)
+            return
+
+        position, points = rank
+        embed = discord.Embed(title="User Rank", description=None, color=discord.Color.gold())
+        embed.add_field(name="Username:", value=f"`{user.name}`", inline=False)
+        embed.add_field(name="Rank:", value=f"`#{position}`", inline=False)
+        embed.add_field(name="Points:", value=f"`{points}`", inline=False)
+
+        await interaction.response.send_message(embed=embed)
+
     @commands.has_permissions(administrator=True)
     @app_commands.command(name="end-poll", description="To decide the result of the poll and end it.")
+    @metrics.timed("command.end-poll")
     async def end_poll(self, interaction: discord.Interaction, poll_id: str):
         poll_id = int(poll_id)
-        if not self.db.poll_exists(poll_id):
+        await self.polls_loaded
+        guild_id = self.poll_guilds.get(poll_id, interaction.guild_id)
+        db = self.databases.get(guild_id)
+        if not await db.poll_exists(poll_id):
             await interaction.response.send_message("Poll does not exist.", ephemeral=True)
             return
 
-        self.db.cursor.execute("SELECT question, first_option, second_option, first_joinees, second_joinees, is_active FROM polls WHERE pollid = ?", (poll_id,))
-        poll = self.db.cursor.fetchone()
+        poll = await db.get_poll(poll_id)
         if not poll:
             await interaction.response.send_message("Poll not found.", ephemeral=True)
             return
 
-        question, first_option, second_option, first_joinees, second_joinees, is_active = poll
+        question, first_option, second_option, is_active, winning_option, channel_id = poll
+        if not self.poll_in_guild(poll_id, channel_id, interaction.guild_id):
+            await interaction.response.send_message("Poll does not exist.", ephemeral=True)
+            return
 
-        if not is_active:
+        if winning_option is not None:
             await interaction.response.send_message("This poll has already been ended.", ephemeral=True)
             return
 
+        cog = self
+
         class PollDropdown(discord.ui.Select):
             def __init__(self):
                 options = [
@@ -129,28 +639,24 @@ class Polls(commands.Cog):
 
                 self.view.selected_option = self.values[0]
                 winning_option = self.view.selected_option
-                if winning_option == first_option:
-                    winning_joinees = first_joinees
-                    losing_joinees = second_joinees
-                else:
-                    winning_joinees = second_joinees
-                    losing_joinees = first_joinees
+                winning_index = 1 if winning_option == first_option else 2
+                totals = await cog.databases.get(self.view.guild_id).settle_poll(poll_id, winning_index)
+                if totals is None:
+                    return await interaction.response.send_message("This poll has already been ended.", ephemeral=True)
 
-                total_losing_points = sum(int(bet.split(":")[1]) for bet in losing_joinees.split(",") if bet)
-                winning_users = [bet.split(":") for bet in winning_joinees.split(",") if bet]
+                cog.active_polls.pop(poll_id, None)
+                cog.poll_guilds.pop(poll_id, None)
+                await cog.disable_poll_buttons(poll_id, channel_id, first_option, second_option)
 
-                for user_id, bet_amount in winning_users:
-                    user_id = int(user_id)
-                    bet_amount = int(bet_amount)
-                    dividend = bet_amount + (total_losing_points * (bet_amount / sum(int(bet.split(":")[1]) for bet in winning_joinees.split(",") if bet)))
-                    self.view.db.add_points(user_id, int(dividend))
-
-                self.view.db.set_poll_inactive(poll_id)
+                winning_votes, winning_points = totals[winning_index]
+                losing_votes, losing_points = totals[3 - winning_index]
+                winning_joinees = f"{winning_votes} users bet {winning_points} points"
+                losing_joinees = f"{losing_votes} users bet {losing_points} points"
 
                 # Calculate percentages and number of voters
-                total_votes = len(first_joinees.split(",")) + len(second_joinees.split(","))
-                first_option_votes = len(first_joinees.split(",")) if first_joinees else 0
-                second_option_votes = len(second_joinees.split(",")) if second_joinees else 0
+                first_option_votes = totals[1][0]
+                second_option_votes = totals[2][0]
+                total_votes = first_option_votes + second_option_votes
 
                 first_option_percentage = (first_option_votes / total_votes) * 100 if total_votes > 0 else 0
                 second_option_percentage = (second_option_votes / total_votes) * 100 if total_votes > 0 else 0
@@ -163,9 +669,9 @@ class Polls(commands.Cog):
                 await interaction.response.send_message(embed=embed, ephemeral=True)
 
         class PollDropdownView(discord.ui.View):
-            def __init__(self, db):
+            def __init__(self, guild_id):
                 super().__init__()
-                self.db = db
+                self.guild_id = guild_id
                 self.selected_option = None
                 self.add_item(PollDropdown())
 
@@ -173,56 +679,53 @@ class Polls(commands.Cog):
         embed.add_field(name="Option 1", value=first_option, inline=False)
         embed.add_field(name="Option 2", value=second_option, inline=False)
 
-        await interaction.response.send_message(embed=embed, view=PollDropdownView(self.db), ephemeral=True)
+        await interaction.response.send_message(embed=embed, view=PollDropdownView(guild_id), ephemeral=True)
 
     @commands.has_permissions(administrator=True)
     @app_commands.command(name="create-poll", description="For admins to create a poll.")
+    @metrics.timed("command.create-poll")
     async def create_poll(self, interaction: discord.Interaction, question: str, first_option: str, second_option: str, expiry_time_hours: int, channel: discord.TextChannel):
         if interaction.user.guild_permissions.administrator:
             message = await interaction.response.defer(ephemeral=True)
-            embed = discord.Embed(title=question, description=None, color=discord.Color.blurple())
-            embed.add_field(name="Option 1:", value=first_option, inline=False)
-            embed.add_field(name="Option 2:", value=second_option, inline=False)
-
-            embed.set_image(url="https://www.ovationmr.com/wp-content/uploads/2021/09/Poll-vs.-Survey.webp")
-
-            async def button_callback(button_interaction: discord.Interaction):
-                if not self.db.poll_not_expired(pollid=button_interaction.message.id):
-                    return await interaction.response.send_message(content="The Poll Has Expired!", ephemeral=True)
+            embed = self.poll_embed(question, first_option, second_option)
 
-                self.db.add_user(userid=button_interaction.user.id, username=button_interaction.user.name)
-                button_custom_id = button_interaction.data["custom_id"]
-                poll_id = button_interaction.message.id
-
-                if self.db.poll_not_expired(pollid=poll_id):
-                    value_modal = ValueModal(button_custom_id=button_custom_id, user_points=self.db.get_user_points(button_interaction.user.id), db=self.db, pollid=poll_id)
-                    await button_interaction.response.send_modal(value_modal)
-                else:
-                    await button_interaction.response.send_message("Poll has expired.", ephemeral=True)
-
-            first_option_button = discord.ui.Button(label=first_option, custom_id=f"{first_option}", style=discord.ButtonStyle.blurple)
-            second_option_button = discord.ui.Button(label=second_option, custom_id=second_option, style=discord.ButtonStyle.blurple)
-
-            first_option_button.callback = button_callback
-            second_option_button.callback = button_callback
-
-            view = discord.ui.View()
-            view.add_item(first_option_button)
-            view.add_item(second_option_button)
+            # Clicks are routed through the persistent PollView registered in setup(), so this copy is only used for its layout
+            view = PollView(self, first_option, second_option)
+            view.stop()
 
             new_poll = await channel.send(embed=embed, view=view)
-            print(new_poll.id)
-            self.db.add_poll(pollid=new_poll.id, question=question, first_option=first_option, second_option=second_option, expiry_time_hours=int(time.time() + (expiry_time_hours * 60 * 60)), is_active=1)
-            await interaction.followup.send(content=f"Poll Created Successfully In {channel.mention}", ephemeral=True)
+            expiry_time = int(time.time() + (expiry_time_hours * 60 * 60))
+            await self.databases.get(interaction.guild_id).add_poll(pollid=new_poll.id, question=question, first_option=first_option, second_option=second_option, expiry_time_hours=expiry_time, is_active=1, channel_id=channel.id)
+            self.track_poll(new_poll.id, expiry_time, interaction.guild_id)
+            self.poll_tallies.track(new_poll.id, question, first_option, second_option, channel.id)
+            await interaction.followup.send(content=f"Poll Created Successfully In {channel.mention} (Poll ID: `{new_poll.id}`)", ephemeral=True)
         else:
             await interaction.response.send_message(content="You don't have the required permissions to perform this action.", ephemeral=True)
 
+class PollView(discord.ui.View):
+    def __init__(self, cog: Polls, first_option: str = "Option 1", second_option: str = "Option 2", disabled: bool = False):
+        """
+        The buttons of every poll message.
+        The custom_id of each button only names the option, the poll is the message it is attached to,
+        so a single instance registered with bot.add_view() handles clicks on every poll, including ones created before a restart.
+        :param cog: The Polls cog that handles clicks.
+        :param first_option: Label of the first button.
+        :param second_option: Label of the second button.
+        :param disabled: Whether the buttons are disabled.
+        """
+        super().__init__(timeout=None)
+        for option, label in ((1, first_option), (2, second_option)):
+            button = discord.ui.Button(label=label, custom_id=f"poll:{option}", style=discord.ButtonStyle.blurple, disabled=disabled)
+            button.callback = functools.partial(cog.poll_button_clicked, option)
+            self.add_item(button)
+
 class ValueModal(discord.ui.Modal):
-    def __init__(self, button_custom_id: str, user_points: int, db: Database, pollid: int):
-        self.db = db
+    def __init__(self, option: int, option_label: str, cog: Polls, guild_id: int, pollid: int):
+        self.cog = cog
+        self.guild_id = guild_id
         self.pollid = pollid
-        self.user_points = user_points
-        self.button_custom_id = button_custom_id
+        self.option = option
+        self.option_label = option_label
         super().__init__(title="Enter your bet amount")
 
         self.add_item(discord.ui.TextInput(
@@ -233,22 +736,26 @@ class ValueModal(discord.ui.Modal):
             style=discord.TextStyle.short,
         ))
 
+    @metrics.timed("modal.bet")
     async def on_submit(self, interaction: discord.Interaction):
         user_input = self.children[0].value
 
-        if user_input.isdigit():
+        if user_input.isdigit() and int(user_input) > 0:
             number = int(user_input)
 
-            if number > self.user_points:
-                await interaction.response.send_message(content="You don't have enough points to perform this action.", ephemeral=True)
-            else:
-                response = self.db.add_user_to_poll(userid=interaction.user.id, poll_option=self.button_custom_id, pollid=self.pollid, bet_amount=number)
-                if response == 2:
-                    return await interaction.response.send_message(content="You have already voted in this poll.", ephemeral=True)
+            # Looked up on submit, the guild's database may have been closed while the modal was open
+            db = self.cog.databases.get(self.guild_id)
+            response = await db.place_bet(userid=interaction.user.id, pollid=self.pollid, option=self.option, amount=number)
+            if response == BET_INSUFFICIENT:
+                return await interaction.response.send_message(content="You don't have enough points to perform this action.", ephemeral=True)
+            if response == BET_DUPLICATE:
+                return await interaction.response.send_message(content="You have already voted in this poll.", ephemeral=True)
+            if response == BET_CLOSED:
+                return await interaction.response.send_message(content="Poll has expired.", ephemeral=True)
 
-                self.db.remove_points(userid=interaction.user.id, points=number)
+            self.cog.poll_tallies.add(self.pollid, self.option, number)
 
-                await interaction.response.send_message(content=f"You have bet {number} points on {self.button_custom_id}", ephemeral=True)
+            await interaction.response.send_message(content=f"You have bet {number} points on {self.option_label}", ephemeral=True)
 
         else:
             await interaction.response.send_message(
@@ -259,4 +766,6 @@ class ValueModal(discord.ui.Modal):
         await interaction.response.send_message("You cancelled the modal.", ephemeral=True)
 
 async def setup(bot):
-    await bot.add_cog(Polls(bot))
\ No newline at end of file
+    cog = Polls(bot)
+    await bot.add_cog(cog)
+    bot.add_view(PollView(cog))
\ No newline at end of file
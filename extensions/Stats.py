@@ -0,0 +1,107 @@
+import discord
+import asyncio, dotenv, functools, os, time
+from discord import app_commands
+from discord.ext import commands, tasks
+from functions.Metrics import metrics
+
+dotenv.load_dotenv()
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", 0.5))
+METRICS_FILE = os.getenv("METRICS_FILE")
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+METRICS_INTERVAL = float(os.getenv("METRICS_INTERVAL", 15))
+
+class Stats(commands.Cog):
+    def __init__(self, bot):
+        self.bot = bot
+        self.lag_task = None
+        self.server = None
+        self.original_request = None
+
+    async def cog_load(self):
+        self.instrument_http()
+        self.lag_task = asyncio.create_task(self.monitor_loop_lag())
+        if METRICS_FILE:
+            self.export_metrics.change_interval(seconds=METRICS_INTERVAL)
+            self.export_metrics.start()
+        if METRICS_PORT:
+            self.server = await asyncio.start_server(self.serve_metrics, METRICS_HOST, METRICS_PORT)
+
+    async def cog_unload(self):
+        self.lag_task.cancel()
+        self.export_metrics.cancel()
+        if self.server is not None:
+            self.server.close()
+        if self.original_request is not None:
+            self.bot.http.request = self.original_request
+
+    def instrument_http(self):
+        # Every REST call made by discord.py goes through HTTPClient.request, time them per route
+        http = getattr(self.bot, "http", None)
+        if http is None:
+            return
+        self.original_request = request = http.request
+
+        @functools.wraps(request)
+        async def timed_request(route, **kwargs):
+            name = f"discord.{route.method} {route.path}"
+            started = time.perf_counter()
+            try:
+                return await request(route, **kwargs)
+            except Exception:
+                metrics.increment(f"{name}.errors")
+                raise
+            finally:
+                metrics.observe(name, time.perf_counter() - started)
+
+        http.request = timed_request
+
+    async def monitor_loop_lag(self):
+        # The time a sleep overshoots its deadline is how long the loop was busy with other callbacks
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            metrics.observe("loop.lag", max(0.0, time.perf_counter() - started - LOOP_LAG_INTERVAL))
+
+    @tasks.loop(seconds=15)
+    async def export_metrics(self):
+        temporary = f"{METRICS_FILE}.tmp"
+        with open(temporary, "w") as file:
+            file.write(metrics.prometheus())
+        os.replace(temporary, METRICS_FILE)
+
+    async def serve_metrics(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            # Any request gets the metrics, only the headers have to be consumed
+            while (await reader.readline()).strip():
+                pass
+            body = metrics.prometheus().encode()
+            writer.write(
+                b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                + f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode()
+                + body
+            )
+            await writer.drain()
+        finally:
+            writer.close()
+
+    @commands.has_permissions(administrator=True)
+    @app_commands.command(name="bot-stats", description="For admins to see where the bot spends its time.")
+    async def stats(self, interaction: discord.Interaction):
+        if not interaction.user.guild_permissions.administrator:
+            await interaction.response.send_message(content="You don't have the required permissions to perform this action.", ephemeral=True)
+            return
+
+        embed = discord.Embed(title="Bot Stats", description="Operations ordered by total time spent", color=discord.Color.blurple())
+        for name, count, total, p50, p99, slowest in metrics.summary()[:20]:
+            embed.add_field(
+                name=name,
+                value=f"`{count}` calls, avg `{total / count * 1000:.2f}ms`, p50 `{p50 * 1000:.1f}ms`, p99 `{p99 * 1000:.1f}ms`, max `{slowest * 1000:.1f}ms`",
+                inline=False,
+            )
+        embed.set_footer(text=f"Uptime {int(time.time() - metrics.started)}s, gateway latency {self.bot.latency * 1000:.0f}ms")
+
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+
+async def setup(bot):
+    await bot.add_cog(Stats(bot))
@@ -0,0 +1,112 @@
+import asyncio, functools, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from functions.Database import Database
+from functions.Leaderboard import Leaderboard
+from functions.Metrics import metrics
+from functions.UserCache import UserCache
+
+# Database methods that only read, these run on the reader pool instead of the writer thread.
+READ_METHODS = {
+    "poll_exists",
+    "get_top_users",
+    "get_user_rank",
+    "poll_not_expired",
+    "get_poll",
+    "get_poll_tallies",
+    "get_poll_bets",
+    "get_active_polls",
+    "get_unsettled_polls",
+    "get_poll_expiry_time",
+    "user_exists",
+    "get_user_points",
+    "get_all_users",
+    "export_users_csv",
+    "ledger_position",
+    "replay_balances",
+    "verify_balances",
+    "backup",
+}
+
+class AsyncDatabase:
+    def __init__(self, db_name, readers=2, cache_size=100000, reader_pool=None):
+        """
+        Initialize the AsyncDatabase class, an awaitable facade over Database.
+        Writes are serialized on a dedicated writer thread and lookups run on a pool of reader threads,
+        each thread owning its own connection, so database work never blocks the event loop.
+        :param db_name: Name of the SQLite database file.
+        :param readers: Number of reader threads.
+        :param cache_size: Number of user balances kept in memory.
+        :param reader_pool: Optional executor shared with other databases to run lookups on instead of a pool of their own.
+        """
+        self.db_name = db_name
+        self.leaderboard = Leaderboard()
+        self.cache = UserCache(cache_size)
+        self.local = threading.local()
+        self.connections = []
+        self.connections_lock = threading.Lock()
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self.owns_readers = reader_pool is None
+        self.readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-reader") if reader_pool is None else reader_pool
+        # Creating the schema and warming the leaderboard run in the background, readers wait for the schema before connecting
+        self.schema_ready = self.writer.submit(self.get_connection, False)
+        self.writer.submit(self.run, "load_leaderboard", (), {})
+
+    def get_connection(self, read_only: bool) -> Database:
+        """
+        Get the Database owned by the current worker thread, connecting on first use.
+        :param read_only: Whether the current thread is a reader.
+        :return: The thread's Database.
+        """
+        db = getattr(self.local, "db", None)
+        if db is None:
+            if read_only:
+                self.schema_ready.result()
+            db = self.local.db = Database(self.db_name, read_only=read_only, leaderboard=self.leaderboard, cache=self.cache)
+            with self.connections_lock:
+                self.connections.append(db)
+        return db
+
+    def run(self, name: str, args, kwargs):
+        started = time.perf_counter()
+        db = self.get_connection(name in READ_METHODS)
+        try:
+            return getattr(db, name)(*args, **kwargs)
+        except Exception:
+            metrics.increment(f"db.{name}.errors")
+            raise
+        finally:
+            db.end_read()
+            metrics.observe(f"db.{name}", time.perf_counter() - started)
+
+    def __getattr__(self, name):
+        if name.startswith("_") or not callable(getattr(Database, name, None)):
+            raise AttributeError(name)
+
+        executor = self.readers if name in READ_METHODS else self.writer
+
+        # db.<name> is the time spent in SQLite, db_await.<name> also includes waiting for a free thread
+        @metrics.timed(f"db_await.{name}")
+        async def method(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(executor, functools.partial(self.run, name, args, kwargs))
+
+        method.__name__ = name
+        setattr(self, name, method)
+        return method
+
+    async def close_connection(self):
+        """
+        Wait for queued queries to finish, then close every connection.
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.shutdown)
+
+    def shutdown(self):
+        self.writer.shutdown(wait=True)
+        if self.owns_readers:
+            self.readers.shutdown(wait=True)
+        with self.connections_lock:
+            # The writer connected first and is closed last, only a writable connection can checkpoint and remove the WAL file
+            for db in reversed(self.connections):
+                db.close_connection()
+            self.connections.clear()
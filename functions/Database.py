@@ -1,16 +1,115 @@
-import sqlite3, time
+import contextlib, csv, sqlite3, time
+
+# Applied to every connection, journal_mode and auto_vacuum are stored in the database file so they only have to be set once.
+# auto_vacuum only applies to a file created with it, Database.compact() converts older files.
+PRAGMAS = {
+    "auto_vacuum": "INCREMENTAL",
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,
+    "cache_size": -16000,
+    "mmap_size": 268435456,
+    "temp_store": "MEMORY",
+}
+
+# Stored in every file as PRAGMA user_version, files written before every guild had its own database have 0
+SCHEMA_VERSION = 1
+
+# Results of Database.place_bet
+BET_PLACED = 1
+BET_DUPLICATE = 2
+BET_INSUFFICIENT = 3
+BET_CLOSED = 4
+
+# Reasons recorded with each ledger entry
+LEDGER_MESSAGE = "message"
+LEDGER_BET = "bet"
+LEDGER_PAYOUT = "payout"
+LEDGER_ADMIN = "admin"
+LEDGER_DELETE = "delete"
+LEDGER_CORRECTION = "correction"
+LEDGER_PURCHASE = "purchase"
+
+class BackupRestarted(Exception):
+    """
+    Raised to stop a paged backup that keeps starting over because other connections write to the database.
+    """
 
 class Database:
-    def __init__(self, db_name):
+    def __init__(self, db_name, read_only=False, leaderboard=None, cache=None, pragmas=PRAGMAS):
         """
         Initialize the Database class, connect to the database, and create the users table if it doesn't exist.
         :param db_name: Name of the SQLite database file.
+        :param read_only: Skip schema creation and refuse writes, for connections that are only used for lookups.
+        :param leaderboard: Optional Leaderboard kept in sync with every balance change made through this connection.
+        :param cache: Optional UserCache consulted before the users table and kept in sync with every balance change.
+        :param pragmas: The pragmas to apply to the connection.
         """
         self.db_name = db_name
-        self.connection = sqlite3.connect(self.db_name)
+        self.leaderboard = leaderboard
+        self.cache = cache
+        self.transaction_depth = 0
+        self.pending_changes = []
+        self.connection = sqlite3.connect(self.db_name, check_same_thread=False)
         self.cursor = self.connection.cursor()
+        for name, value in pragmas.items():
+            if read_only and name in ("journal_mode", "auto_vacuum"):
+                continue
+            self.cursor.execute(f'PRAGMA {name} = {value}')
+        if read_only:
+            self.cursor.execute('PRAGMA query_only = 1')
+            return
         self.create_users_table()
+        self.create_bets_table()
         self.create_polls_table()
+        self.create_ledger_tables()
+        self.create_purchases_table()
+        self.migrate_joinees()
+        self.cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Group several calls into one transaction, methods called inside it don't commit on their own.
+        The transaction is committed when the outermost scope exits and rolled back if it raises.
+        """
+        self.transaction_depth += 1
+        try:
+            yield self
+        except BaseException:
+            self.transaction_depth -= 1
+            if self.transaction_depth == 0:
+                self.connection.rollback()
+                self.pending_changes.clear()
+            raise
+        self.transaction_depth -= 1
+        self.commit()
+
+    def commit(self):
+        """
+        Commit the current transaction, unless it belongs to an enclosing transaction() scope.
+        """
+        if self.transaction_depth:
+            return
+        if not self.pending_changes:
+            self.connection.commit()
+            return
+
+        changes, self.pending_changes = self.pending_changes, []
+        if self.cache is not None:
+            self.cache.begin_write()
+        try:
+            self.connection.commit()
+        except Exception:
+            # A failed commit leaves the transaction open, the next commit would save it without these changes
+            self.connection.rollback()
+            changes = []
+            raise
+        finally:
+            if self.leaderboard is not None:
+                self.leaderboard.apply(changes)
+            if self.cache is not None:
+                self.cache.apply(changes)
 
     def create_users_table(self):
         """
@@ -23,7 +122,8 @@ class Database:
             points INTEGER DEFAULT 0
         )
         ''')
-        self.connection.commit()
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_points ON users (points DESC)')
+        self.commit()
         
     def create_polls_table(self):
         """
@@ -38,10 +138,259 @@ class Database:
             second_option TEXT NOT NULL,
             second_joinees TEXT,
             expiry_time INTEGER NOT NULL,
-            is_active INTEGER NOT NULL
+            is_active INTEGER NOT NULL,
+            channel_id INTEGER,
+            winning_option INTEGER,
+            first_bettors INTEGER NOT NULL DEFAULT 0,
+            first_points INTEGER NOT NULL DEFAULT 0,
+            second_bettors INTEGER NOT NULL DEFAULT 0,
+            second_points INTEGER NOT NULL DEFAULT 0
+        )
+        ''')
+        self.add_column('polls', 'channel_id', 'INTEGER')
+        if self.add_column('polls', 'winning_option', 'INTEGER'):
+            # Polls ended before this column existed were already paid out, their winner is unknown
+            self.cursor.execute('UPDATE polls SET winning_option = 0 WHERE is_active = 0')
+        tallies_added = False
+        for column in ('first_bettors', 'first_points', 'second_bettors', 'second_points'):
+            tallies_added = self.add_column('polls', column, 'INTEGER NOT NULL DEFAULT 0') or tallies_added
+        if tallies_added:
+            self.recount_tallies()
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_polls_active_expiry ON polls (is_active, expiry_time)')
+        self.commit()
+
+    def add_column(self, table: str, column: str, definition: str) -> bool:
+        """
+        Add a column to an existing table if it is missing, used to migrate databases created by older versions.
+        :param table: The name of the table.
+        :param column: The name of the column.
+        :param definition: The column type and constraints.
+        :return: True if the column was added, False if it already existed.
+        """
+        self.cursor.execute(f'PRAGMA table_info({table})')
+        if any(row[1] == column for row in self.cursor.fetchall()):
+            return False
+        self.cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+        return True
+
+    def create_bets_table(self):
+        """
+        Create the 'bets' table if it does not exist.
+        Each row is one user's bet on a poll, a user can only bet once per poll.
+        """
+        self.cursor.execute('''
+        CREATE TABLE IF NOT EXISTS bets (
+            pollid INTEGER NOT NULL,
+            userid INTEGER NOT NULL,
+            option INTEGER NOT NULL,
+            amount INTEGER NOT NULL,
+            UNIQUE (pollid, userid)
         )
         ''')
-        self.connection.commit()
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_bets_poll_option ON bets (pollid, option)')
+        self.commit()
+
+    def create_ledger_tables(self):
+        """
+        Create the 'ledger' and checkpoint tables if they do not exist.
+        Every balance change is appended to the ledger, and checkpoints snapshot every balance at a ledger position,
+        so balances can be re-derived from the latest checkpoint instead of the whole history.
+        A database created before the ledger existed gets an opening checkpoint of its current balances.
+        """
+        self.cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'ledger'")
+        existed = self.cursor.fetchone() is not None
+        self.cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ledger (
+            id INTEGER PRIMARY KEY,
+            userid INTEGER NOT NULL,
+            delta INTEGER NOT NULL,
+            reason TEXT NOT NULL,
+            reference INTEGER,
+            created REAL NOT NULL
+        )
+        ''')
+        self.cursor.execute('''
+        CREATE TABLE IF NOT EXISTS checkpoints (
+            id INTEGER PRIMARY KEY,
+            ledger_id INTEGER NOT NULL,
+            created REAL NOT NULL
+        )
+        ''')
+        self.cursor.execute('''
+        CREATE TABLE IF NOT EXISTS checkpoint_balances (
+            checkpoint_id INTEGER NOT NULL,
+            userid INTEGER NOT NULL,
+            points INTEGER NOT NULL,
+            PRIMARY KEY (checkpoint_id, userid)
+        ) WITHOUT ROWID
+        ''')
+        if not existed:
+            self.checkpoint_balances()
+        self.commit()
+
+    def create_purchases_table(self):
+        """
+        Create the 'purchases' table if it does not exist.
+        Each row is one shop item bought by a user, for admins to hand out.
+        """
+        self.cursor.execute('''
+        CREATE TABLE IF NOT EXISTS purchases (
+            id INTEGER PRIMARY KEY,
+            userid INTEGER NOT NULL,
+            item TEXT NOT NULL,
+            price INTEGER NOT NULL,
+            created REAL NOT NULL
+        )
+        ''')
+        self.commit()
+
+    def record_ledger(self, entries):
+        """
+        Append balance changes to the ledger, in the caller's transaction.
+        :param entries: An iterable of (userid, delta, reason, reference) tuples, reference is the poll ID for bets and payouts and the purchase ID for purchases.
+        """
+        created = time.time()
+        self.cursor.executemany(
+            'INSERT INTO ledger (userid, delta, reason, reference, created) VALUES (?, ?, ?, ?, ?)',
+            ((userid, delta, reason, reference, created) for userid, delta, reason, reference in entries),
+        )
+
+    def checkpoint_balances(self, keep: int = 3):
+        """
+        Snapshot every non-zero balance together with the current end of the ledger.
+        :param keep: Number of most recent checkpoints to keep, older ones are deleted.
+        :return: The ID of the new checkpoint.
+        """
+        with self.transaction():
+            self.cursor.execute('INSERT INTO checkpoints (ledger_id, created) SELECT COALESCE(MAX(id), 0), ? FROM ledger', (time.time(),))
+            checkpoint_id = self.cursor.lastrowid
+            self.cursor.execute('INSERT INTO checkpoint_balances (checkpoint_id, userid, points) SELECT ?, userid, points FROM users WHERE points != 0', (checkpoint_id,))
+            self.cursor.execute('SELECT id FROM checkpoints ORDER BY id DESC LIMIT -1 OFFSET ?', (keep,))
+            expired = self.cursor.fetchall()
+            self.cursor.executemany('DELETE FROM checkpoint_balances WHERE checkpoint_id = ?', expired)
+            self.cursor.executemany('DELETE FROM checkpoints WHERE id = ?', expired)
+        return checkpoint_id
+
+    def ledger_position(self):
+        """
+        Get how far the ledger has grown past the latest checkpoint.
+        :return: A (last ledger ID, ledger ID of the latest checkpoint) tuple.
+        """
+        self.cursor.execute('SELECT (SELECT COALESCE(MAX(id), 0) FROM ledger), (SELECT COALESCE(MAX(ledger_id), 0) FROM checkpoints)')
+        return self.cursor.fetchone()
+
+    def replay_balances(self, until: int = None):
+        """
+        Re-derive balances from the latest checkpoint and the ledger entries written after it.
+        :param until: Only replay ledger entries up to this ID, starting from the latest checkpoint before it.
+        :return: A dict mapping user IDs to points, users whose balance is zero are left out.
+        """
+        if until is None:
+            self.cursor.execute('SELECT id, ledger_id FROM checkpoints ORDER BY id DESC LIMIT 1')
+        else:
+            self.cursor.execute('SELECT id, ledger_id FROM checkpoints WHERE ledger_id <= ? ORDER BY id DESC LIMIT 1', (until,))
+        checkpoint = self.cursor.fetchone()
+        if checkpoint is None:
+            raise ValueError("No checkpoint to replay from")
+        checkpoint_id, ledger_id = checkpoint
+
+        self.cursor.execute('SELECT userid, points FROM checkpoint_balances WHERE checkpoint_id = ?', (checkpoint_id,))
+        balances = dict(self.cursor.fetchall())
+        if until is None:
+            self.cursor.execute('SELECT userid, SUM(delta) FROM ledger WHERE id > ? GROUP BY userid', (ledger_id,))
+        else:
+            self.cursor.execute('SELECT userid, SUM(delta) FROM ledger WHERE id > ? AND id <= ? GROUP BY userid', (ledger_id, until))
+        for userid, delta in self.cursor.fetchall():
+            balances[userid] = balances.get(userid, 0) + delta
+        return {userid: points for userid, points in balances.items() if points}
+
+    def verify_balances(self):
+        """
+        Compare the balances in the users table with the ones re-derived from the ledger.
+        :return: A list of (userid, ledger points, table points) tuples for every user that differs.
+        """
+        # Both reads have to see the same snapshot, writes from other connections may land in between
+        self.cursor.execute('BEGIN')
+        try:
+            expected = self.replay_balances()
+            self.cursor.execute('SELECT userid, points FROM users WHERE points != 0')
+            actual = dict(self.cursor.fetchall())
+        finally:
+            self.connection.rollback()
+        return [
+            (userid, expected.get(userid, 0), actual.get(userid, 0))
+            for userid in sorted(expected.keys() | actual.keys())
+            if expected.get(userid, 0) != actual.get(userid, 0)
+        ]
+
+    def restore_balances(self, balances):
+        """
+        Set the balances in the users table and append corrections to the ledger, so that both end up at the given balances.
+        Corrections are taken against the ledger rather than the table, which also repairs balances changed outside of it.
+        :param balances: A dict mapping user IDs to their correct points, users left out are set to zero.
+        :return: The number of users whose balance in the table changed.
+        """
+        with self.transaction():
+            ledger = self.replay_balances()
+            self.cursor.execute('SELECT userid, points FROM users')
+            table = dict(self.cursor.fetchall())
+            changed = [(balances.get(userid, 0) - points, userid) for userid, points in table.items() if balances.get(userid, 0) != points]
+            corrections = [
+                (userid, balances.get(userid, 0) - ledger.get(userid, 0), LEDGER_CORRECTION, None)
+                for userid in table
+                if balances.get(userid, 0) != ledger.get(userid, 0)
+            ]
+            self.cursor.executemany('UPDATE users SET points = points + ? WHERE userid = ?', changed)
+            self.record_ledger(corrections)
+            self.balances_changed((userid, None, delta, False) for delta, userid in changed)
+        return len(changed)
+
+    def recount_tallies(self, pollids=None):
+        """
+        Rebuild the per-option bettor and point totals of polls from the 'bets' table.
+        place_bet keeps them up to date, this is only needed for bets written some other way.
+        :param pollids: The IDs of the polls to recount, every poll if None.
+        """
+        recount = '''
+            UPDATE polls SET
+                first_bettors = (SELECT COUNT(*) FROM bets WHERE bets.pollid = polls.pollid AND option = 1),
+                first_points = (SELECT COALESCE(SUM(amount), 0) FROM bets WHERE bets.pollid = polls.pollid AND option = 1),
+                second_bettors = (SELECT COUNT(*) FROM bets WHERE bets.pollid = polls.pollid AND option = 2),
+                second_points = (SELECT COALESCE(SUM(amount), 0) FROM bets WHERE bets.pollid = polls.pollid AND option = 2)
+        '''
+        with self.transaction():
+            if pollids is None:
+                self.cursor.execute(recount)
+            else:
+                self.cursor.executemany(recount + ' WHERE pollid = ?', [(pollid,) for pollid in pollids])
+
+    def migrate_joinees(self):
+        """
+        Move bets stored in the legacy comma-separated 'first_joinees'/'second_joinees' columns into the 'bets' table.
+        Migrated polls have their joinee columns cleared, so running this again is a no-op.
+        """
+        self.cursor.execute("SELECT pollid, first_joinees, second_joinees FROM polls WHERE first_joinees != '' OR second_joinees != ''")
+        rows = self.cursor.fetchall()
+        if not rows:
+            return
+
+        bets = []
+        for pollid, first_joinees, second_joinees in rows:
+            for option, joinees in ((1, first_joinees), (2, second_joinees)):
+                for joinee in (joinees or "").split(","):
+                    try:
+                        userid, amount = joinee.split(":")
+                        userid, amount = int(userid), int(amount)
+                    except ValueError:
+                        continue
+                    # Older versions accepted bets of 0, which stake nothing and can't be paid out
+                    if amount > 0:
+                        bets.append((pollid, userid, option, amount))
+
+        with self.transaction():
+            self.cursor.executemany('INSERT OR IGNORE INTO bets (pollid, userid, option, amount) VALUES (?, ?, ?, ?)', bets)
+            self.cursor.executemany("UPDATE polls SET first_joinees = '', second_joinees = '' WHERE pollid = ?", [(row[0],) for row in rows])
+            self.recount_tallies(row[0] for row in rows)
         
     def poll_exists(self, pollid):
         """
@@ -58,28 +407,88 @@ class Database:
         :param pollid: The ID of the poll to set as inactive.
         :return: True if the poll was set as inactive successfully, False otherwise.
         """
-        if self.poll_exists(pollid):
+        with self.transaction():
             self.cursor.execute('UPDATE polls SET is_active = 0 WHERE pollid = ?', (pollid,))
-            self.connection.commit()
-            return True
-        return False
+            return self.cursor.rowcount == 1
 
-    def add_poll(self , pollid: int , question: str , first_option: str , second_option: str , expiry_time_hours: float , is_active: int):
+    def add_poll(self , pollid: int , question: str , first_option: str , second_option: str , expiry_time_hours: float , is_active: int, channel_id: int = None):
         
-        if not self.poll_exists(pollid):
-            self.cursor.execute('INSERT INTO polls (pollid, question, first_option, first_joinees, second_option, second_joinees, expiry_time, is_active) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (pollid, question, first_option, "", second_option, "", expiry_time_hours, is_active))
-            self.connection.commit()
-            return True
-        return False
+        with self.transaction():
+            self.cursor.execute('INSERT INTO polls (pollid, question, first_option, first_joinees, second_option, second_joinees, expiry_time, is_active, channel_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(pollid) DO NOTHING', (pollid, question, first_option, "", second_option, "", expiry_time_hours, is_active, channel_id))
+            return self.cursor.rowcount == 1
+
+    def get_active_polls(self):
+        """
+        Get every poll that is still open for bets.
+        :return: A list of (pollid, expiry_time) tuples.
+        """
+        self.cursor.execute('SELECT pollid, expiry_time FROM polls WHERE is_active = 1')
+        return self.cursor.fetchall()
+
+    def get_unsettled_polls(self):
+        """
+        Get every poll that no longer takes bets but has not been paid out yet.
+        :return: A list of poll IDs.
+        """
+        self.cursor.execute('SELECT pollid FROM polls WHERE is_active = 0 AND winning_option IS NULL')
+        return [row[0] for row in self.cursor.fetchall()]
+
+    def close_expired_polls(self, now: float):
+        """
+        Stop accepting bets on every open poll whose expiry time has passed.
+        :param now: The current unix time.
+        :return: A list of (pollid, channel_id, first_option, second_option) tuples for the polls that were closed.
+        """
+        with self.transaction():
+            self.cursor.execute('SELECT pollid, channel_id, first_option, second_option FROM polls WHERE is_active = 1 AND expiry_time <= ?', (now,))
+            expired = self.cursor.fetchall()
+            self.cursor.executemany('UPDATE polls SET is_active = 0 WHERE pollid = ?', [(row[0],) for row in expired])
+        return expired
     
+    def load_leaderboard(self):
+        """
+        Fill the leaderboard from the users table.
+        This must run on the connection that makes all writes, so no balance change can slip in between the read and the load.
+        """
+        if self.leaderboard is not None:
+            self.cursor.execute('SELECT userid, username, points FROM users')
+            self.leaderboard.load(self.cursor.fetchall())
+
+    def balances_changed(self, changes):
+        """
+        Queue point changes for the leaderboard and cache, they are applied once the current transaction commits.
+        :param changes: An iterable of (userid, username, delta, created) tuples.
+            username is only needed when the user may not exist yet, created marks users inserted with delta points,
+            and a delta of None means the user was deleted.
+        """
+        if self.leaderboard is not None or self.cache is not None:
+            self.pending_changes.extend(changes)
+
     def get_top_users(self, limit=10):
         """
         Retrieve the top users by points.
         :param limit: Number of top users to retrieve.
         :return: A list of tuples containing user data.
         """
+        if self.leaderboard is not None and self.leaderboard.loaded:
+            return self.leaderboard.top(limit)
         self.cursor.execute('SELECT username, points FROM users ORDER BY points DESC LIMIT ?', (limit,))
         return self.cursor.fetchall()
+
+    def get_user_rank(self, userid):
+        """
+        Get a user's position on the leaderboard.
+        :param userid: The ID of the user.
+        :return: A (rank, points) tuple, or None if the user does not exist.
+        """
+        if self.leaderboard is not None and self.leaderboard.loaded:
+            return self.leaderboard.rank(userid)
+        self.cursor.execute('SELECT points FROM users WHERE userid = ?', (userid,))
+        row = self.cursor.fetchone()
+        if row is None:
+            return None
+        self.cursor.execute('SELECT COUNT(*) FROM users WHERE points > ?', row)
+        return self.cursor.fetchone()[0] + 1, row[0]
     
     def poll_not_expired(self, pollid: int):
         if self.poll_exists(pollid=pollid):
@@ -91,69 +500,155 @@ class Database:
             return False
     
     def add_user_to_poll(self, userid: int, poll_option: str, pollid: str, bet_amount: int) -> int | bool:
-        if self.poll_exists(pollid=pollid):
-            self.cursor.execute("""
-                SELECT first_joinees, second_joinees
-                FROM polls
-                WHERE pollid = ?""", (pollid, ))
-            
-            first_joined_users, second_joined_users = self.cursor.fetchone()
-            all_joinees = f"{first_joined_users},{second_joined_users}"
-            all_joinees_list = all_joinees.split(",")
-            all_joinees_cleaned = []
-            for joinee in all_joinees_list:
-                try:
-                    all_joinees_cleaned.append(int(joinee.split(":")[0]) )
-                except:
-                    continue
-
-            if userid in all_joinees_cleaned:
+        """
+        Record a user's bet on one of the options of a poll.
+        :param userid: The ID of the user placing the bet.
+        :param poll_option: The label of the chosen option.
+        :param pollid: The ID of the poll.
+        :param bet_amount: The number of points bet.
+        :return: True if the bet was recorded, 2 if the user already bet on this poll, False if the poll is closed or does not exist.
+        """
+        self.cursor.execute('SELECT first_option, second_option FROM polls WHERE pollid = ? AND is_active = 1 AND expiry_time > ?', (pollid, time.time()))
+        row = self.cursor.fetchone()
+        if not row:
+            return False
+
+        first_option, second_option = row
+        if poll_option == first_option:
+            option = 1
+        elif poll_option == second_option:
+            option = 2
+        else:
+            return False
+
+        with self.transaction():
+            try:
+                self.cursor.execute('INSERT INTO bets (pollid, userid, option, amount) VALUES (?, ?, ?, ?)', (pollid, userid, option, bet_amount))
+            except sqlite3.IntegrityError:
                 return 2
-            
-            self.cursor.execute("""
-                SELECT first_option, second_option, first_joinees, second_joinees
-                FROM polls
-                WHERE pollid = ?
-            """, (pollid, ))
-            
-            row = self.cursor.fetchone()
-            
-            if not row:
-                print("No matching option found.")
-                return
-            
-            first_option, second_option, first_joinees, second_joinees = row
-            
-            if poll_option == first_option:
-                # Update first_joinees
-                new_first_joinees = f"{first_joinees},{userid}:{bet_amount}" if first_joinees else f"{userid}:{bet_amount}"
-                self.cursor.execute("""
-                    UPDATE polls
-                    SET first_joinees = ?
-                    WHERE first_option = ?
-                """, (new_first_joinees, first_option))
-            
-            elif poll_option == second_option:
-                # Update second_joinees
-                new_second_joinees = f"{second_joinees},{userid}:{bet_amount}" if second_joinees else f"{userid}:{bet_amount}"
-                self.cursor.execute("""
-                    UPDATE polls
-                    SET second_joinees = ?
-                    WHERE second_option = ?
-                """, (new_second_joinees, second_option))
-            
-            else:
-                print("Option does not match either column.")
-                return False
-            
-            self.connection.commit()
-            print("User ID added successfully.")
-            return True
-            
-        return False
+            self.add_to_tally(pollid, option, bet_amount)
+        return True
+
+    def add_to_tally(self, pollid: int, option: int, amount: int):
+        """
+        Count a new bet in the running totals of a poll, in the caller's transaction.
+        :param pollid: The ID of the poll.
+        :param option: The chosen option, 1 or 2.
+        :param amount: The number of points bet.
+        """
+        prefix = "first" if option == 1 else "second"
+        self.cursor.execute(f'UPDATE polls SET {prefix}_bettors = {prefix}_bettors + 1, {prefix}_points = {prefix}_points + ? WHERE pollid = ?', (amount, pollid))
+
+    def place_bet(self, userid: int, pollid: int, option: int, amount: int) -> int:
+        """
+        Debit a user's points and record their bet in a single transaction.
+        The bet is only inserted if the balance covers it and the debit is conditional on the same balance,
+        so concurrent bets can never overspend or be recorded without being paid for.
+        :param userid: The ID of the user placing the bet.
+        :param pollid: The ID of the poll.
+        :param option: The chosen option, 1 or 2.
+        :param amount: The number of points bet, must be positive.
+        :return: BET_PLACED, BET_DUPLICATE if the user already bet on this poll, BET_INSUFFICIENT if the balance is too low
+            or BET_CLOSED if the poll is closed or does not exist.
+        """
+        if amount <= 0:
+            return BET_INSUFFICIENT
+        if self.cache is not None:
+            current_points = self.cache.get(userid)
+            if current_points is not None and current_points < amount:
+                return BET_INSUFFICIENT
+
+        with self.transaction():
+            self.cursor.execute('SELECT 1 FROM polls WHERE pollid = ? AND is_active = 1 AND expiry_time > ?', (pollid, time.time()))
+            if self.cursor.fetchone() is None:
+                return BET_CLOSED
+
+            try:
+                self.cursor.execute('''
+                    INSERT INTO bets (pollid, userid, option, amount)
+                    SELECT ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM users WHERE userid = ? AND points >= ?)
+                ''', (pollid, userid, option, amount, userid, amount))
+            except sqlite3.IntegrityError:
+                return BET_DUPLICATE
+            if self.cursor.rowcount == 0:
+                return BET_INSUFFICIENT
+
+            self.cursor.execute('UPDATE users SET points = points - ? WHERE userid = ? AND points >= ?', (amount, userid, amount))
+            self.balances_changed([(userid, None, -amount, False)])
+            self.record_ledger([(userid, -amount, LEDGER_BET, pollid)])
+            self.add_to_tally(pollid, option, amount)
+
+        return BET_PLACED
+
+    def get_poll(self, pollid: int):
+        """
+        Get the details of a poll.
+        :param pollid: The ID of the poll.
+        :return: A (question, first_option, second_option, is_active, winning_option, channel_id) tuple, or None if the poll does not exist.
+        """
+        self.cursor.execute('SELECT question, first_option, second_option, is_active, winning_option, channel_id FROM polls WHERE pollid = ?', (pollid,))
+        return self.cursor.fetchone()
+
+    def get_poll_tallies(self, pollid: int):
+        """
+        Get the running totals of a poll.
+        :param pollid: The ID of the poll.
+        :return: A dict mapping each option to a (bettors, points) tuple, or None if the poll does not exist.
+        """
+        self.cursor.execute('SELECT first_bettors, first_points, second_bettors, second_points FROM polls WHERE pollid = ?', (pollid,))
+        row = self.cursor.fetchone()
+        if row is None:
+            return None
+        return {1: (row[0], row[1]), 2: (row[2], row[3])}
+
+    def get_poll_bets(self, pollid: int):
+        """
+        Get every bet placed on a poll.
+        :param pollid: The ID of the poll.
+        :return: A list of (userid, option, amount) tuples, where option is 1 or 2.
+        """
+        self.cursor.execute('SELECT userid, option, amount FROM bets WHERE pollid = ?', (pollid,))
+        return self.cursor.fetchall()
     
+    def settle_poll(self, pollid: int, winning_option: int):
+        """
+        Pay out a poll, record its winner and mark it inactive in a single transaction.
+        Each winner gets their bet back plus a share of the losing pool proportional to their bet.
+        :param pollid: The ID of the poll.
+        :param winning_option: The winning option, 1 or 2.
+        :return: A dict mapping each option to a (bettors, points) tuple, or None if the poll does not exist or was already ended.
+        """
+        with self.transaction():
+            self.cursor.execute('UPDATE polls SET is_active = 0, winning_option = ? WHERE pollid = ? AND winning_option IS NULL', (winning_option, pollid))
+            if self.cursor.rowcount == 0:
+                return None
+
+            totals = self.get_poll_tallies(pollid)
+
+            winning_points = totals[winning_option][1]
+            losing_points = totals[3 - winning_option][1]
+            # Bets of 0 points, which older versions accepted, win nothing, so a winning side without points settles like one without bets
+            self.cursor.execute('SELECT userid, amount FROM bets WHERE pollid = ? AND option = ?', (pollid, winning_option))
+            payouts = []
+            paid_out = 0
+            for userid, amount in (self.cursor.fetchall() if winning_points else []):
+                share, remainder = divmod(losing_points * amount, winning_points)
+                payouts.append((remainder, amount + share, userid))
+                paid_out += share
+
+            # Points lost to rounding go to the largest remainders, so the losing pool is paid out in full
+            leftover = losing_points - paid_out if payouts else 0
+            if leftover:
+                payouts.sort(reverse=True)
+            payouts = [(payout + (index < leftover), userid) for index, (_, payout, userid) in enumerate(payouts)]
+            self.cursor.executemany('UPDATE users SET points = points + ? WHERE userid = ?', payouts)
+            self.balances_changed((userid, None, payout, False) for payout, userid in payouts)
+            self.record_ledger((userid, payout, LEDGER_PAYOUT, pollid) for payout, userid in payouts)
+
+        return totals
+
     def get_poll_expiry_time(self, pollid: int):
-        self.cursor.execute("SELECT expiry_time FROM polls WHERE id = ?", (pollid,))
+        self.cursor.execute("SELECT expiry_time FROM polls WHERE pollid = ?", (pollid,))
         row = self.cursor.fetchone()
         if row:
             return row[0]
@@ -167,8 +662,7 @@ class Database:
         :param userid: The ID of the user to check.
         :return: True if the user exists, False otherwise.
         """
-        self.cursor.execute('SELECT 1 FROM users WHERE userid = ?', (userid,))
-        return self.cursor.fetchone() is not None
+        return self.get_user_points(userid) is not None
 
     def add_user(self, userid, username):
         """
@@ -177,37 +671,115 @@ class Database:
         :param username: The username of the new user.
         :return: True if the user was added successfully, False otherwise.
         """
-        if not self.user_exists(userid):
-            self.cursor.execute('INSERT INTO users (userid, username) VALUES (?, ?)', (userid, username))
-            self.connection.commit()
-            return True
-        return False
+        if self.cache is not None and self.cache.get(userid) is not None:
+            return False
+        with self.transaction():
+            self.cursor.execute('INSERT INTO users (userid, username) VALUES (?, ?) ON CONFLICT(userid) DO NOTHING', (userid, username))
+            added = self.cursor.rowcount == 1
+            if added:
+                self.balances_changed([(userid, username, 0, True)])
+        return added
 
-    def add_points(self, userid, points):
+    def add_points(self, userid, points, reason=LEDGER_ADMIN):
         """
         Add points to a user's wallet.
         :param userid: The ID of the user.
         :param points: The number of points to add.
+        :param reason: The reason recorded in the ledger.
         """
-        if self.user_exists(userid):
+        with self.transaction():
             self.cursor.execute('UPDATE users SET points = points + ? WHERE userid = ?', (points, userid))
-            self.connection.commit()
+            if self.cursor.rowcount:
+                self.balances_changed([(userid, None, points, False)])
+                self.record_ledger([(userid, points, reason, None)])
+
+    def add_points_bulk(self, awards, reason=LEDGER_MESSAGE):
+        """
+        Add points to many users in a single transaction, creating users that don't exist yet.
+        :param awards: A list of (userid, username, points) tuples.
+        :param reason: The reason recorded in the ledger.
+        """
+        with self.transaction():
+            self.cursor.executemany('''
+                INSERT INTO users (userid, username, points) VALUES (?, ?, ?)
+                ON CONFLICT(userid) DO UPDATE SET points = points + excluded.points
+            ''', awards)
+            self.balances_changed((userid, username, points, False) for userid, username, points in awards)
+            self.record_ledger((userid, points, reason, None) for userid, _, points in awards)
+
+    def adjust_points_bulk(self, adjustments, reason=LEDGER_ADMIN):
+        """
+        Add or remove points for many users in a single transaction.
+        Positive adjustments create users that don't exist yet, negative ones are skipped for users who don't have enough points.
+        :param adjustments: A list of (userid, username, points) tuples, points may be negative.
+        :param reason: The reason recorded in the ledger.
+        :return: The IDs of the users whose points could not be removed.
+        """
+        grants = [(userid, username, points) for userid, username, points in adjustments if points >= 0]
+        removals = [(userid, -points) for userid, _, points in adjustments if points < 0]
+        skipped = []
+        with self.transaction():
+            self.cursor.executemany('''
+                INSERT INTO users (userid, username, points) VALUES (?, ?, ?)
+                ON CONFLICT(userid) DO UPDATE SET points = points + excluded.points
+            ''', grants)
+            self.balances_changed((userid, username, points, False) for userid, username, points in grants)
+            self.record_ledger((userid, points, reason, None) for userid, _, points in grants)
+
+            # Each removal is conditional on its own balance, so they run one by one, still inside the one transaction
+            removed = []
+            for userid, points in removals:
+                self.cursor.execute('UPDATE users SET points = points - ? WHERE userid = ? AND points >= ?', (points, userid, points))
+                if self.cursor.rowcount:
+                    removed.append((userid, points))
+                else:
+                    skipped.append(userid)
+            self.balances_changed((userid, None, -points, False) for userid, points in removed)
+            self.record_ledger((userid, -points, reason, None) for userid, points in removed)
+        return skipped
 
-    def remove_points(self, userid, points):
+    def remove_points(self, userid, points, reason=LEDGER_ADMIN):
         """
         Remove points from a user's wallet.
         :param userid: The ID of the user.
         :param points: The number of points to remove.
+        :param reason: The reason recorded in the ledger.
         :return: True if the points were removed successfully, False if insufficient points.
         """
-        if self.user_exists(userid):
+        if self.cache is not None:
+            current_points = self.cache.get(userid)
+            if current_points is not None and current_points < points:
+                return False
+        with self.transaction():
+            self.cursor.execute('UPDATE users SET points = points - ? WHERE userid = ? AND points >= ?', (points, userid, points))
+            removed = self.cursor.rowcount == 1
+            if removed:
+                self.balances_changed([(userid, None, -points, False)])
+                self.record_ledger([(userid, -points, reason, None)])
+        return removed
+
+    def purchase(self, userid: int, item: str, price: int):
+        """
+        Debit the price of a shop item and record the purchase in a single transaction.
+        :param userid: The ID of the user buying the item.
+        :param item: The name of the item.
+        :param price: The price of the item.
+        :return: The user's remaining points, or None if they can't afford the item or don't exist.
+        """
+        if self.cache is not None:
+            current_points = self.cache.get(userid)
+            if current_points is not None and current_points < price:
+                return None
+
+        with self.transaction():
+            self.cursor.execute('UPDATE users SET points = points - ? WHERE userid = ? AND points >= ?', (price, userid, price))
+            if self.cursor.rowcount == 0:
+                return None
+            self.cursor.execute('INSERT INTO purchases (userid, item, price, created) VALUES (?, ?, ?, ?)', (userid, item, price, time.time()))
+            self.record_ledger([(userid, -price, LEDGER_PURCHASE, self.cursor.lastrowid)])
+            self.balances_changed([(userid, None, -price, False)])
             self.cursor.execute('SELECT points FROM users WHERE userid = ?', (userid,))
-            current_points = self.cursor.fetchone()[0]
-            if current_points >= points:
-                self.cursor.execute('UPDATE users SET points = points - ? WHERE userid = ?', (points, userid))
-                self.connection.commit()
-                return True
-        return False
+            return self.cursor.fetchone()[0]
 
     def get_user_points(self, userid):
         """
@@ -215,10 +787,19 @@ class Database:
         :param userid: The ID of the user.
         :return: The number of points the user has, or None if the user does not exist.
         """
-        if self.user_exists(userid):
-            self.cursor.execute('SELECT points FROM users WHERE userid = ?', (userid,))
-            return self.cursor.fetchone()[0]
-        return None
+        token = None
+        if self.cache is not None:
+            points = self.cache.get(userid)
+            if points is not None:
+                return points
+            token = self.cache.token()
+        self.cursor.execute('SELECT points FROM users WHERE userid = ?', (userid,))
+        row = self.cursor.fetchone()
+        if row is None:
+            return None
+        if self.cache is not None:
+            self.cache.fill(userid, row[0], token)
+        return row[0]
 
     def get_all_users(self):
         """
@@ -228,17 +809,150 @@ class Database:
         self.cursor.execute('SELECT * FROM users')
         return self.cursor.fetchall()
 
+    def iter_users(self, batch_size: int = 1000):
+        """
+        Iterate over every user without loading the whole table into memory.
+        Uses its own cursor, so other queries can run on this connection while iterating.
+        :param batch_size: Number of rows fetched from SQLite at a time.
+        :return: A generator of (userid, username, points) tuples, ordered by user ID.
+        """
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute('SELECT userid, username, points FROM users ORDER BY userid')
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    return
+                yield from rows
+        finally:
+            cursor.close()
+
+    def export_users_csv(self, file_path: str) -> int:
+        """
+        Write every user to a CSV file with a userid,username,points header, streaming rows from the table.
+        :param file_path: The path of the CSV file to write.
+        :return: The number of users written.
+        """
+        count = 0
+        with open(file_path, "w", newline="", encoding="utf-8") as file:
+            writer = csv.writer(file)
+            writer.writerow(("userid", "username", "points"))
+            for row in self.iter_users():
+                writer.writerow(row)
+                count += 1
+        return count
+
     def delete_user(self, userid):
         """
         Delete a user from the database.
         :param userid: The ID of the user to delete.
         """
-        if self.user_exists(userid):
+        with self.transaction():
+            # The remaining balance is written off in the ledger, so replaying it still ends at zero for this user
+            self.cursor.execute('''
+                INSERT INTO ledger (userid, delta, reason, reference, created)
+                SELECT userid, -points, ?, NULL, ? FROM users WHERE userid = ? AND points != 0
+            ''', (LEDGER_DELETE, time.time(), userid))
             self.cursor.execute('DELETE FROM users WHERE userid = ?', (userid,))
-            self.connection.commit()
+            if self.cursor.rowcount:
+                self.balances_changed([(userid, None, None, False)])
+
+    def backup(self, file_path: str, pages: int = 1024, sleep: float = 0.005, restarts: int = 3) -> int:
+        """
+        Copy the database to a file while the bot keeps using it, a few pages at a time.
+        A write from another connection between two steps makes the copy start over, so after too many restarts
+        the rest is copied in one step, which reads a single WAL snapshot and does not block writers either.
+        :param file_path: The path of the copy, overwritten if it exists.
+        :param pages: Number of pages copied per step.
+        :param sleep: Seconds to wait between steps.
+        :param restarts: Number of times the copy may start over before it is done in one step.
+        :return: The number of pages in the copy.
+        """
+        progress = {"remaining": None, "restarts": 0}
+
+        def track(status, remaining, total):
+            if progress["remaining"] is not None and remaining > progress["remaining"]:
+                progress["restarts"] += 1
+                if progress["restarts"] > restarts:
+                    raise BackupRestarted(file_path)
+            progress["remaining"] = remaining
+
+        target = sqlite3.connect(file_path)
+        try:
+            try:
+                self.connection.backup(target, pages=pages, progress=track, sleep=sleep)
+            except BackupRestarted:
+                self.connection.backup(target, pages=-1)
+            # The copy inherits WAL mode, a rollback journal keeps it a single self-contained file
+            target.execute('PRAGMA journal_mode = DELETE')
+            return target.execute('PRAGMA page_count').fetchone()[0]
+        finally:
+            target.close()
+
+    def prune_polls(self, before: float, limit: int = 500):
+        """
+        Delete settled polls that expired before a given time, along with their bets.
+        Their bets and payouts stay in the ledger, which refers to them by poll ID.
+        Polls that expired without being ended are kept, they still have to be paid out.
+        :param before: Unix time, settled polls that expired before it are deleted.
+        :param limit: Most polls deleted per call, so a single call never holds the writer for long.
+        :return: A (polls deleted, bets deleted) tuple.
+        """
+        with self.transaction():
+            self.cursor.execute('SELECT pollid FROM polls WHERE is_active = 0 AND expiry_time < ? AND winning_option IS NOT NULL LIMIT ?', (before, limit))
+            pollids = self.cursor.fetchall()
+            if not pollids:
+                return 0, 0
+            self.cursor.executemany('DELETE FROM bets WHERE pollid = ?', pollids)
+            bets = self.cursor.rowcount
+            self.cursor.executemany('DELETE FROM polls WHERE pollid = ?', pollids)
+        return len(pollids), bets
+
+    def compact(self, pages: int = None) -> int:
+        """
+        Give free pages back to the filesystem and truncate the WAL file.
+        With incremental auto_vacuum free pages are released in place, without rewriting the file.
+        A database created before auto_vacuum was enabled needs one full VACUUM to switch over,
+        which rewrites the whole file and holds the writer until it is done.
+        :param pages: Most free pages to release, every free page if None.
+        :return: The number of pages released.
+        """
+        self.commit()
+        self.cursor.execute('PRAGMA freelist_count')
+        free_pages = self.cursor.fetchone()[0]
+        self.cursor.execute('PRAGMA auto_vacuum')
+        if self.cursor.fetchone()[0] == 2:
+            # incremental_vacuum releases one page per step and execute() only steps it once, executescript() runs it to the end
+            self.cursor.executescript('PRAGMA incremental_vacuum' if pages is None else f'PRAGMA incremental_vacuum({int(pages)})')
+        else:
+            self.cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            self.cursor.execute('VACUUM')
+        self.cursor.execute('PRAGMA freelist_count')
+        released = free_pages - self.cursor.fetchone()[0]
+        self.cursor.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        self.cursor.fetchall()
+        return released
+
+    def analyze(self, limit: int = 1000):
+        """
+        Refresh the table statistics the query planner uses to choose indexes.
+        :param limit: Approximate number of rows sampled per index, 0 to read every row.
+        """
+        self.cursor.execute(f'PRAGMA analysis_limit = {int(limit)}')
+        self.cursor.execute('ANALYZE')
+        self.commit()
+
+    def end_read(self):
+        """
+        Finish the cursor's last query.
+        A SELECT read with fetchone() stays open and keeps its read snapshot, which stops WAL checkpoints from completing.
+        """
+        self.cursor.close()
+        self.cursor = self.connection.cursor()
 
     def close_connection(self):
         """
         Close the database connection.
         """
+        self.cursor.close()
         self.connection.close()
\ No newline at end of file
@@ -0,0 +1,200 @@
+import asyncio, calendar, contextlib, os, re, sqlite3, time
+from concurrent.futures import ThreadPoolExecutor
+from functions.AsyncDatabase import AsyncDatabase
+from functions.Database import SCHEMA_VERSION
+
+class GuildDatabases:
+    def __init__(self, directory: str = "./database", default_guild_id: int = None, readers: int = 4, cache_size: int = 100000):
+        """
+        Initialize the GuildDatabases class, a registry giving every guild its own SQLite file.
+        Each guild gets its own writer thread, so a busy guild never queues behind another one,
+        while lookups for every guild share one pool of reader threads. A guild that has gone quiet can be closed,
+        giving back its writer thread and file handles until its next use.
+        The default guild, and anything outside a guild, keeps using the original users.db.
+        :param directory: Directory holding users.db, guild files are kept in its 'guilds' subdirectory.
+        :param default_guild_id: The guild whose data is in users.db, from before the bot was split per guild.
+        :param readers: Number of reader threads shared by every guild.
+        :param cache_size: Number of user balances each guild keeps in memory.
+        """
+        self.directory = directory
+        self.default_guild_id = default_guild_id
+        self.cache_size = cache_size
+        self.reader_pool = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-reader")
+        self.databases = {}
+        self.last_used = {}
+        self.used = set()
+        self.in_use = {}
+        os.makedirs(os.path.join(directory, "guilds"), exist_ok=True)
+
+    def __len__(self):
+        return len(self.databases)
+
+    def path(self, guild_id: int) -> str:
+        """
+        Get the file holding a guild's data.
+        :param guild_id: The ID of the guild, or None outside of a guild.
+        :return: The path of the SQLite file.
+        """
+        if guild_id is None or guild_id == self.default_guild_id:
+            return os.path.join(self.directory, "users.db")
+        return os.path.join(self.directory, "guilds", f"{int(guild_id)}.db")
+
+    def get(self, guild_id: int, use: bool = True) -> AsyncDatabase:
+        """
+        Get a guild's database, opening it on first use or after it was closed for being idle.
+        :param guild_id: The ID of the guild, or None outside of a guild.
+        :param use: Whether the guild is using its database, False when it is only opened for housekeeping, see hold().
+        :return: The guild's AsyncDatabase.
+        """
+        if guild_id == self.default_guild_id:
+            guild_id = None
+        db = self.databases.get(guild_id)
+        if db is None:
+            db = self.databases[guild_id] = AsyncDatabase(self.path(guild_id), cache_size=self.cache_size, reader_pool=self.reader_pool)
+            self.last_used[guild_id] = time.monotonic()
+        if use:
+            self.last_used[guild_id] = time.monotonic()
+            self.used.add(guild_id)
+        return db
+
+    @contextlib.contextmanager
+    def hold(self, guild_id: int):
+        """
+        Keep a guild's database open for housekeeping such as backups, close() leaves it alone until the block ends.
+        Unlike get(), this doesn't count as the guild using its database.
+        :param guild_id: The ID of the guild, or None outside of a guild.
+        :return: The guild's AsyncDatabase.
+        """
+        if guild_id == self.default_guild_id:
+            guild_id = None
+        db = self.get(guild_id, use=False)
+        self.in_use[guild_id] = self.in_use.get(guild_id, 0) + 1
+        try:
+            yield db
+        finally:
+            self.in_use[guild_id] -= 1
+            if not self.in_use[guild_id]:
+                del self.in_use[guild_id]
+
+    def legacy_default_file(self) -> bool:
+        """
+        Check whether users.db holds users or polls written before every guild had its own database.
+        No guild reaches them unless default_guild_id names the guild they belong to.
+        :return: True if users.db has such data, False otherwise.
+        """
+        path = self.path(None)
+        if not os.path.exists(path):
+            return False
+        connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            if connection.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+                return False
+            tables = {row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            return any(connection.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone() for table in ("users", "polls") if table in tables)
+        finally:
+            connection.close()
+
+    def stored_guilds(self) -> list[int]:
+        """
+        Get every guild that has data on disk.
+        :return: A list of guild IDs, None stands for users.db.
+        """
+        guilds = [None] if os.path.exists(self.path(None)) else []
+        for name in os.listdir(os.path.join(self.directory, "guilds")):
+            match = re.fullmatch(r"(\d+)\.db", name)
+            if match:
+                guilds.append(int(match.group(1)))
+        return guilds
+
+    def backups(self, guild_id: int) -> list[str]:
+        """
+        Get a guild's snapshots.
+        :param guild_id: The ID of the guild, or None outside of a guild.
+        :return: The snapshot paths, oldest first.
+        """
+        name = os.path.splitext(os.path.basename(self.path(guild_id)))[0]
+        directory = os.path.join(self.directory, "backups")
+        if not os.path.isdir(directory):
+            return []
+        files = sorted(file for file in os.listdir(directory) if re.fullmatch(rf"{re.escape(name)}-\d{{8}}-\d{{6}}\.db", file))
+        return [os.path.join(directory, file) for file in files]
+
+    def backup_age(self, guild_id: int):
+        """
+        Get how long ago a guild's newest snapshot was taken, from the UTC time in its name.
+        :param guild_id: The ID of the guild, or None outside of a guild.
+        :return: The age in seconds, or None if the guild has no snapshot.
+        """
+        backups = self.backups(guild_id)
+        if not backups:
+            return None
+        taken = time.strptime(os.path.basename(backups[-1])[-18:-3], "%Y%m%d-%H%M%S")
+        return time.time() - calendar.timegm(taken)
+
+    async def backup(self, guild_id: int, keep: int = 4, pages: int = 1024, sleep: float = 0.005) -> str:
+        """
+        Snapshot a guild's database into the 'backups' subdirectory and delete its oldest snapshots.
+        :param guild_id: The ID of the guild, or None outside of a guild.
+        :param keep: Number of snapshots to keep for the guild, including the new one.
+        :param pages: Number of pages copied per step, see Database.backup.
+        :param sleep: Seconds to wait between steps.
+        :return: The path of the new snapshot.
+        """
+        name = os.path.splitext(os.path.basename(self.path(guild_id)))[0]
+        directory = os.path.join(self.directory, "backups")
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{name}-{time.strftime('%Y%m%d-%H%M%S', time.gmtime())}.db")
+
+        # Copied under a temporary name, so a copy cut short is never mistaken for a snapshot
+        with self.hold(guild_id) as db:
+            await db.backup(path + ".tmp", pages, sleep)
+        os.replace(path + ".tmp", path)
+
+        for old_path in self.backups(guild_id)[:-keep]:
+            os.remove(old_path)
+        return path
+
+    def items(self):
+        """
+        Get every open guild database.
+        :return: A list of (guild_id, AsyncDatabase) tuples.
+        """
+        return list(self.databases.items())
+
+    def idle(self, seconds: float):
+        """
+        Get the open guild databases that have not been used for a while.
+        :param seconds: How long a database has to have gone unused.
+        :return: A list of (guild_id, AsyncDatabase) tuples.
+        """
+        cutoff = time.monotonic() - seconds
+        return [(guild_id, self.databases[guild_id]) for guild_id, used in self.last_used.items() if used <= cutoff and guild_id not in self.in_use]
+
+    async def close(self, guild_id: int, idle: float = 0) -> bool:
+        """
+        Wait for a guild's queued queries to finish, then close its connections and writer thread.
+        The database is opened again on its next use.
+        :param guild_id: The ID of the guild, or None outside of a guild.
+        :param idle: Only close the database if it has not been used for this many seconds.
+        :return: True if the database was closed, False if it wasn't open, was used too recently or is held.
+        """
+        if guild_id == self.default_guild_id:
+            guild_id = None
+        if guild_id not in self.databases or guild_id in self.in_use or time.monotonic() - self.last_used[guild_id] < idle:
+            return False
+        db = self.databases.pop(guild_id)
+        del self.last_used[guild_id]
+        self.used.discard(guild_id)
+        await db.close_connection()
+        return True
+
+    async def close_connection(self):
+        """
+        Wait for queued queries to finish, then close every guild's connections.
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.reader_pool.shutdown, True)
+        await asyncio.gather(*(db.close_connection() for db in self.databases.values()))
+        self.databases.clear()
+        self.last_used.clear()
+        self.used.clear()
@@ -0,0 +1,139 @@
+import bisect, itertools, threading
+
+# Keys per bucket of the ranking, a bucket is split once it grows to twice this size
+BUCKET_SIZE = 1000
+# A user's key is (-points << USERID_BITS) + userid, one int orders like the (-points, userid) tuple and compares much faster
+USERID_BITS = 64
+USERID_MASK = (1 << USERID_BITS) - 1
+
+def user_key(points: int, userid: int) -> int:
+    return (-points << USERID_BITS) + userid
+
+class Leaderboard:
+    def __init__(self):
+        """
+        Initialize the Leaderboard class, an in-memory ranking of every user by points.
+        Users are ordered by points, then user ID, in a list of sorted buckets, so a change only shifts the keys of one bucket
+        instead of the whole ranking, the top users are the front of the first buckets and a rank is a binary search.
+        The ranking is empty until load() is called; until then callers should fall back to the database.
+        """
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.buckets = []
+        self.maxes = []
+        self.users = {}
+
+    def load(self, rows):
+        """
+        Replace the ranking with a full snapshot of the users table.
+        :param rows: An iterable of (userid, username, points) tuples.
+        """
+        users = {userid: [username, points] for userid, username, points in rows}
+        buckets, maxes = self.build(users)
+        with self.lock:
+            self.users = users
+            self.buckets = buckets
+            self.maxes = maxes
+            self.loaded = True
+
+    def build(self, users):
+        """
+        Sort every user into buckets.
+        :param users: A dict mapping user IDs to [username, points] lists.
+        :return: A (buckets, maxes) tuple, maxes holds the last key of each bucket.
+        """
+        keys = sorted(user_key(points, userid) for userid, (_, points) in users.items())
+        buckets = [keys[start:start + BUCKET_SIZE] for start in range(0, len(keys), BUCKET_SIZE)]
+        return buckets, [bucket[-1] for bucket in buckets]
+
+    def apply(self, changes):
+        """
+        Apply committed point changes.
+        Once loaded the ranking holds every user, so a user it doesn't know yet was just created with delta points.
+        :param changes: An iterable of (userid, username, delta, created) tuples, a delta of None means the user was deleted.
+        """
+        changes = list(changes)
+        with self.lock:
+            if not self.loaded:
+                return
+            # Past about a tenth of the users, sorting everything once is cheaper than moving them one at a time
+            if len(changes) > len(self.users) // 10:
+                for userid, username, delta, _ in changes:
+                    entry = self.users.get(userid)
+                    if delta is None:
+                        self.users.pop(userid, None)
+                    elif entry is None:
+                        if username is not None:
+                            self.users[userid] = [username, delta]
+                    else:
+                        entry[1] += delta
+                self.buckets, self.maxes = self.build(self.users)
+                return
+
+            for userid, username, delta, _ in changes:
+                entry = self.users.get(userid)
+                if delta is None:
+                    if entry is not None:
+                        del self.users[userid]
+                        self.remove(user_key(entry[1], userid))
+                    continue
+                if entry is None:
+                    if username is None:
+                        continue
+                    entry = self.users[userid] = [username, delta]
+                elif delta:
+                    self.remove(user_key(entry[1], userid))
+                    entry[1] += delta
+                else:
+                    continue
+                self.insert(user_key(entry[1], userid))
+
+    def insert(self, key):
+        if not self.buckets:
+            self.buckets.append([key])
+            self.maxes.append(key)
+            return
+        index = min(bisect.bisect_left(self.maxes, key), len(self.buckets) - 1)
+        bucket = self.buckets[index]
+        bisect.insort(bucket, key)
+        self.maxes[index] = bucket[-1]
+        if len(bucket) >= 2 * BUCKET_SIZE:
+            self.buckets[index:index + 1] = [bucket[:BUCKET_SIZE], bucket[BUCKET_SIZE:]]
+            self.maxes[index:index + 1] = [bucket[BUCKET_SIZE - 1], bucket[-1]]
+
+    def remove(self, key):
+        index = bisect.bisect_left(self.maxes, key)
+        bucket = self.buckets[index]
+        del bucket[bisect.bisect_left(bucket, key)]
+        if bucket:
+            self.maxes[index] = bucket[-1]
+        else:
+            del self.buckets[index]
+            del self.maxes[index]
+
+    def top(self, limit=10):
+        """
+        Get the top users by points.
+        :param limit: Number of top users to retrieve.
+        :return: A list of (username, points) tuples.
+        """
+        with self.lock:
+            keys = itertools.islice(itertools.chain.from_iterable(self.buckets), limit)
+            return [(self.users[key & USERID_MASK][0], -(key >> USERID_BITS)) for key in keys]
+
+    def rank(self, userid):
+        """
+        Get a user's position, users with equal points share a position.
+        :param userid: The ID of the user.
+        :return: A (rank, points) tuple, or None if the user is not ranked.
+        """
+        with self.lock:
+            entry = self.users.get(userid)
+            if entry is None:
+                return None
+            points = entry[1]
+            # The first key with these points, every key before it belongs to a user with more points
+            key = user_key(points, 0)
+            index = bisect.bisect_left(self.maxes, key)
+            ahead = sum(len(bucket) for bucket in self.buckets[:index]) + bisect.bisect_left(self.buckets[index], key)
+            return ahead + 1, points
@@ -0,0 +1,53 @@
+import collections, time
+
+class MessageThrottle:
+    def __init__(self, burst: int = 5, interval: float = 10.0, clock=time.monotonic):
+        """
+        Initialize the MessageThrottle class, a token bucket per user limiting how often messages earn points.
+        Every user starts with burst tokens and gets one back every interval seconds, each award spends one.
+        A bucket that has been idle long enough to refill is the same as a new one, so it is dropped,
+        which keeps memory proportional to the users active within the last burst * interval seconds.
+        :param burst: Number of awards a user can earn back to back.
+        :param interval: Seconds it takes to earn back one award.
+        :param clock: Function returning the current time in seconds.
+        """
+        self.burst = burst
+        self.interval = interval
+        self.clock = clock
+        self.refill_time = burst * interval
+        # Ordered by last award, so the idle buckets are always at the front
+        self.buckets = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.buckets)
+
+    def allow(self, key) -> bool:
+        """
+        Check whether a message earns points, spending a token if it does.
+        :param key: Identifies the user, such as a (guild_id, user_id) tuple.
+        :return: True if the message earns points, False if the user is out of tokens.
+        """
+        now = self.clock()
+        self.expire(now)
+
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            self.buckets[key] = [self.burst - 1, now]
+            return True
+
+        tokens, updated = bucket
+        tokens = min(self.burst, tokens + (now - updated) / self.interval)
+        if tokens < 1:
+            return False
+        bucket[0] = tokens - 1
+        bucket[1] = now
+        self.buckets.move_to_end(key)
+        return True
+
+    def expire(self, now: float):
+        # Each message drops at most the buckets that went idle since the last one, so this stays O(1) amortized
+        while self.buckets:
+            key, (_, updated) = next(iter(self.buckets.items()))
+            if now - updated < self.refill_time:
+                break
+            del self.buckets[key]
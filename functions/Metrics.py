@@ -0,0 +1,130 @@
+import asyncio, bisect, functools, threading, time
+
+# Upper bounds, in seconds, of the latency histogram buckets
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    def __init__(self):
+        """
+        Initialize the Histogram class, a fixed-bucket latency histogram.
+        """
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float):
+        self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, fraction: float) -> float:
+        """
+        Estimate a quantile as the upper bound of the bucket it falls in.
+        :param fraction: The quantile, between 0 and 1.
+        :return: The estimate in seconds, or 0 if nothing was observed.
+        """
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank:
+                return BUCKETS[index] if index < len(BUCKETS) else self.max
+        return self.max
+
+class Metrics:
+    def __init__(self):
+        """
+        Initialize the Metrics class, a registry of counters and latency histograms keyed by name.
+        It is safe to record from the database threads and the event loop at the same time.
+        """
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}
+        self.histograms = {}
+
+    def increment(self, name: str, value: int = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name: str, seconds: float):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    def timed(self, name: str):
+        """
+        Decorator recording the latency of every call under name, and counting calls that raise as '<name>.errors'.
+        Works on both plain and coroutine functions.
+        :param name: The metric name.
+        """
+        def decorator(func):
+            if asyncio.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def wrapper(*args, **kwargs):
+                    started = time.perf_counter()
+                    try:
+                        return await func(*args, **kwargs)
+                    except BaseException:
+                        self.increment(f"{name}.errors")
+                        raise
+                    finally:
+                        self.observe(name, time.perf_counter() - started)
+            else:
+                @functools.wraps(func)
+                def wrapper(*args, **kwargs):
+                    started = time.perf_counter()
+                    try:
+                        return func(*args, **kwargs)
+                    except BaseException:
+                        self.increment(f"{name}.errors")
+                        raise
+                    finally:
+                        self.observe(name, time.perf_counter() - started)
+            return wrapper
+        return decorator
+
+    def summary(self):
+        """
+        Get a copy of every histogram.
+        :return: A list of (name, count, total seconds, p50, p99, max) tuples, slowest total first.
+        """
+        with self.lock:
+            rows = [
+                (name, histogram.count, histogram.total, histogram.quantile(0.5), histogram.quantile(0.99), histogram.max)
+                for name, histogram in self.histograms.items()
+            ]
+        return sorted(rows, key=lambda row: row[2], reverse=True)
+
+    def prometheus(self) -> str:
+        """
+        Render every metric in the Prometheus text exposition format.
+        """
+        lines = [
+            "# TYPE bot_uptime_seconds gauge",
+            f"bot_uptime_seconds {time.time() - self.started:.3f}",
+            "# TYPE bot_events_total counter",
+        ]
+        with self.lock:
+            for name, value in sorted(self.counters.items()):
+                lines.append(f'bot_events_total{{name="{name}"}} {value}')
+
+            lines.append("# TYPE bot_latency_seconds histogram")
+            for name, histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(BUCKETS, histogram.buckets):
+                    cumulative += count
+                    lines.append(f'bot_latency_seconds_bucket{{name="{name}",le="{bound}"}} {cumulative}')
+                lines.append(f'bot_latency_seconds_bucket{{name="{name}",le="+Inf"}} {histogram.count}')
+                lines.append(f'bot_latency_seconds_sum{{name="{name}"}} {histogram.total:.6f}')
+                lines.append(f'bot_latency_seconds_count{{name="{name}"}} {histogram.count}')
+        return "\n".join(lines) + "\n"
+
+# Shared by the database layer and the cogs
+metrics = Metrics()
@@ -0,0 +1,43 @@
+class PointsBuffer:
+    def __init__(self, max_size: int = 500):
+        """
+        Initialize the PointsBuffer class, an in-memory accumulator for point awards.
+        Awards for the same user are coalesced until the buffer is drained and written in one batch.
+        :param max_size: Number of distinct pending users at which a flush becomes due.
+        """
+        self.max_size = max_size
+        self.pending = {}
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, userid: int, username: str, points: int) -> bool:
+        """
+        Queue points for a user.
+        :param userid: The ID of the user.
+        :param username: The username of the user, used if the user has to be created.
+        :param points: The number of points to add.
+        :return: True if the buffer has reached its size threshold and should be flushed, False otherwise.
+        """
+        entry = self.pending.get(userid)
+        if entry is None:
+            self.pending[userid] = [username, points]
+        else:
+            entry[1] += points
+        return len(self.pending) >= self.max_size
+
+    def drain(self) -> list[tuple[int, str, int]]:
+        """
+        Take every pending award out of the buffer.
+        :return: A list of (userid, username, points) tuples.
+        """
+        pending, self.pending = self.pending, {}
+        return [(userid, username, points) for userid, (username, points) in pending.items()]
+
+    def restore(self, awards):
+        """
+        Put drained awards back, for when writing them failed. Awards queued since the drain are added to them.
+        :param awards: A list of (userid, username, points) tuples, as returned by drain().
+        """
+        for userid, username, points in awards:
+            self.add(userid, username, points)
@@ -0,0 +1,83 @@
+class PollTallies:
+    def __init__(self):
+        """
+        Initialize the PollTallies class, the running bettor and point totals of every open poll.
+        Each new bet marks its poll as changed, so the poll messages can be refreshed in batches
+        instead of once per bet.
+        """
+        self.polls = {}
+        self.changed = {}
+
+    def __len__(self):
+        return len(self.polls)
+
+    def track(self, pollid: int, question: str, first_option: str, second_option: str, channel_id: int, totals=None):
+        """
+        Start keeping the totals of a poll.
+        :param pollid: The ID of the poll, which is also the ID of its message.
+        :param question: The question of the poll.
+        :param first_option: The label of the first option.
+        :param second_option: The label of the second option.
+        :param channel_id: The ID of the channel the poll message is in.
+        :param totals: The totals so far, a dict mapping each option to a (bettors, points) tuple.
+        """
+        totals = totals or {1: (0, 0), 2: (0, 0)}
+        self.polls[pollid] = {
+            "question": question,
+            "options": {1: first_option, 2: second_option},
+            "channel_id": channel_id,
+            "totals": {option: list(totals[option]) for option in (1, 2)},
+        }
+
+    def get(self, pollid: int):
+        """
+        Get a tracked poll.
+        :param pollid: The ID of the poll.
+        :return: A dict with the question, options, channel_id and totals of the poll, or None if it is not tracked.
+        """
+        return self.polls.get(pollid)
+
+    def add(self, pollid: int, option: int, amount: int) -> bool:
+        """
+        Count a bet and mark its poll as changed.
+        :param pollid: The ID of the poll.
+        :param option: The chosen option, 1 or 2.
+        :param amount: The number of points bet.
+        :return: True if the poll is tracked, False otherwise.
+        """
+        poll = self.polls.get(pollid)
+        if poll is None:
+            return False
+        totals = poll["totals"][option]
+        totals[0] += 1
+        totals[1] += amount
+        self.changed[pollid] = None
+        return True
+
+    def mark_changed(self, pollid: int):
+        if pollid in self.polls:
+            self.changed[pollid] = None
+
+    def drain_changed(self, limit: int) -> list[int]:
+        """
+        Take the polls that changed since they were last drained, oldest change first.
+        :param limit: Maximum number of polls to take, the rest stay marked for the next call.
+        :return: A list of poll IDs.
+        """
+        pollids = []
+        for pollid in self.changed:
+            if len(pollids) == limit:
+                break
+            pollids.append(pollid)
+        for pollid in pollids:
+            del self.changed[pollid]
+        return pollids
+
+    def forget(self, pollid: int):
+        """
+        Stop keeping the totals of a poll.
+        :param pollid: The ID of the poll.
+        :return: The poll as returned by get(), or None if it was not tracked.
+        """
+        self.changed.pop(pollid, None)
+        return self.polls.pop(pollid, None)
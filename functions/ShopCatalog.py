@@ -0,0 +1,57 @@
+import os
+
+class ShopCatalog:
+    def __init__(self, path: str):
+        """
+        Initialize the ShopCatalog class, the shop items parsed from a file with one 'name:price' line per item.
+        The file is parsed again only when its modification time changes, so it can be edited while the bot runs.
+        :param path: Path of the shop file.
+        """
+        self.path = path
+        self.mtime = None
+        self.version = 0
+        self.items = {}
+        self.refresh()
+
+    def __len__(self):
+        return len(self.items)
+
+    def refresh(self) -> bool:
+        """
+        Reload the catalog if the file changed since it was last read.
+        :return: True if the catalog was reloaded, False otherwise.
+        """
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self.mtime:
+            return False
+
+        items = {}
+        if mtime is not None:
+            with open(self.path, "r") as file:
+                for line in file:
+                    name, _, price = line.strip().rpartition(":")
+                    name, price = name.strip(), price.strip()
+                    if name and price.isdigit():
+                        items[name.lower()] = {"name": name, "price": int(price)}
+
+        self.items = items
+        self.mtime = mtime
+        self.version += 1
+        return True
+
+    def get(self, name: str):
+        """
+        Find an item by name, ignoring case.
+        :param name: The name of the item.
+        :return: A dict with the name and price of the item, or None if there is no such item.
+        """
+        return self.items.get(name.strip().lower())
+
+    def all(self) -> list[dict]:
+        """
+        Get every item, in the order of the file.
+        """
+        return list(self.items.values())
@@ -0,0 +1,82 @@
+import collections, threading
+
+class UserCache:
+    def __init__(self, capacity: int = 100000):
+        """
+        Initialize the UserCache class, an LRU-bounded map of known user IDs to their points.
+        The writer keeps it coherent by applying every committed change, readers may only add users they looked up.
+        A lookup racing a commit could bring back a stale balance, so fills are rejected if any write
+        started or finished between token() and fill().
+        :param capacity: Maximum number of users kept in memory.
+        """
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.version = 0
+        self.writing = False
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, userid: int):
+        """
+        Get a user's cached points.
+        :param userid: The ID of the user.
+        :return: The points, or None if the user is not cached.
+        """
+        with self.lock:
+            points = self.entries.get(userid)
+            if points is not None:
+                self.entries.move_to_end(userid)
+            return points
+
+    def token(self):
+        """
+        Take a token before reading a balance from the database, to pass to fill() afterwards.
+        """
+        with self.lock:
+            return None if self.writing else self.version
+
+    def fill(self, userid: int, points: int, token):
+        """
+        Cache a balance read from the database, unless a write may have changed it since the token was taken.
+        :param userid: The ID of the user.
+        :param points: The points read from the database.
+        :param token: The value returned by token() before the read.
+        """
+        with self.lock:
+            if token is None or self.writing or token != self.version or userid in self.entries:
+                return
+            self.put(userid, points)
+
+    def begin_write(self):
+        """
+        Mark that a commit changing balances is about to happen.
+        """
+        with self.lock:
+            self.writing = True
+            self.version += 1
+
+    def apply(self, changes):
+        """
+        Apply committed changes and end the write started by begin_write().
+        :param changes: An iterable of (userid, username, delta, created) tuples, a delta of None means the user was deleted.
+        """
+        with self.lock:
+            for userid, _, delta, created in changes:
+                if delta is None:
+                    self.entries.pop(userid, None)
+                elif userid in self.entries:
+                    self.entries[userid] += delta
+                    self.entries.move_to_end(userid)
+                elif created:
+                    self.put(userid, delta)
+            self.version += 1
+            self.writing = False
+
+    def put(self, userid: int, points: int):
+        # Callers hold the lock
+        self.entries[userid] = points
+        self.entries.move_to_end(userid)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
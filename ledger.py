@@ -0,0 +1,51 @@
+"""
+Re-derive balances from the points ledger.
+
+    python ledger.py verify                    compare every balance with the ledger
+    python ledger.py replay --until ID         show the balances that differ from the ledger as of entry ID
+    python ledger.py replay --until ID --apply restore those balances, recording the differences as corrections
+    python ledger.py checkpoint                snapshot the current balances
+
+Every guild has its own database, pass --database ./database/guilds/<guild_id>.db to work on one other than users.db.
+Stop the bot before using --apply, a restore should not race new bets and payouts.
+"""
+import argparse, sys, time
+from functions.Database import Database
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["verify", "replay", "checkpoint"])
+    parser.add_argument("--database", default="./database/users.db")
+    parser.add_argument("--until", type=int, help="Last ledger entry to replay, the whole ledger if omitted.")
+    parser.add_argument("--apply", action="store_true", help="Write the replayed balances to the users table.")
+    args = parser.parse_args()
+
+    db = Database(args.database)
+    started = time.perf_counter()
+
+    if args.command == "checkpoint":
+        print(f"Created checkpoint {db.checkpoint_balances()}")
+
+    elif args.command == "verify":
+        mismatches = db.verify_balances()
+        for userid, expected, actual in mismatches[:50]:
+            print(f"{userid}: ledger {expected}, table {actual}")
+        print(f"{len(mismatches)} balances differ from the ledger ({time.perf_counter() - started:.2f}s)")
+        if mismatches:
+            sys.exit(1)
+
+    else:
+        balances = db.replay_balances(until=args.until)
+        if args.apply:
+            print(f"Restored {db.restore_balances(balances)} balances ({time.perf_counter() - started:.2f}s)")
+        else:
+            db.cursor.execute('SELECT userid, points FROM users')
+            changes = [(userid, points, balances.get(userid, 0)) for userid, points in db.cursor.fetchall() if balances.get(userid, 0) != points]
+            for userid, points, replayed in changes[:50]:
+                print(f"{userid}: {points} -> {replayed}")
+            print(f"{len(changes)} balances would change, rerun with --apply to restore them ({time.perf_counter() - started:.2f}s)")
+
+    db.close_connection()
+
+if __name__ == "__main__":
+    main()
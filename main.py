@@ -1,24 +1,51 @@
 import dotenv
-import discord, os
+import discord, asyncio, hashlib, json, os
 from discord.ext import commands
 
 # Globals and envs:
 dotenv.load_dotenv('.env')
 
 BOT_TOKEN = os.getenv('BOT_TOKEN')
+COMMAND_HASH_FILE = os.getenv('COMMAND_HASH_FILE', './database/commands.hash')
 
 # All other processing:
 bot = commands.Bot(command_prefix="!" , intents=discord.Intents().all())
+background_tasks = set()
+
+def command_tree_hash() -> str:
+    # Hash of every command as it would be uploaded, so any change to a name, description or parameter changes it
+    payload = sorted((command.to_dict(bot.tree) for command in bot.tree.get_commands()), key=lambda command: (command["name"], command.get("type", 1)))
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+async def sync_commands():
+    # A global sync is slow and rate limited, so it only runs when the commands changed since the last one
+    command_hash = command_tree_hash()
+    try:
+        with open(COMMAND_HASH_FILE, "r") as file:
+            if file.read().strip() == command_hash:
+                return
+    except FileNotFoundError:
+        pass
 
-@bot.event
-async def on_ready():
-    
-    await bot.load_extension("extensions.Polls")
-    
-    print("Loaded Polls extension")
-    
     await bot.tree.sync()
+    with open(COMMAND_HASH_FILE, "w") as file:
+        file.write(command_hash)
+    print("Synced application commands")
+
+@bot.event
+async def setup_hook():
+    # Runs once per process, after login and before connecting to the gateway, unlike on_ready which fires on every reconnect
+    await asyncio.gather(
+        bot.load_extension("extensions.Polls"),
+        bot.load_extension("extensions.Stats"),
+    )
+
+    print("Loaded Polls and Stats extensions")
+
+    task = asyncio.create_task(sync_commands())
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
 
 
 # Running related things:
-bot.run(BOT_TOKEN)
\ No newline at end of file
+bot.run(BOT_TOKEN)